@@ -0,0 +1,134 @@
+'''
+Library API of the tools: inspection, entry counts, downsampling and
+renaming of trees, on a shared pool of open TFiles.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import os
+from collections import OrderedDict
+from utils import walk_key_infos, drop_key_index, resolve_tree, get_tree, \
+    tree_info, cluster_aligned_end, range_dataframe, snapshot_options, \
+    rename_tree
+
+
+class TFilePool:
+    ''' Keeps up to max_open TFiles open so repeated operations on the same
+    files skip the open and streamer info reads. The least recently used
+    file is closed when the limit is reached, which invalidates the objects
+    read from it. '''
+
+    def __init__(self, max_open=16):
+        self.max_open = max_open
+        self._files = OrderedDict()
+
+    @staticmethod
+    def _key(rfilename):
+        return rfilename if '://' in rfilename else \
+            os.path.realpath(rfilename)
+
+    def get(self, rfilename):
+        ''' Returns the open TFile of rfilename. Raises OSError if ROOT
+        cannot open it. '''
+        import ROOT
+        key = self._key(rfilename)
+        tfile = self._files.get(key)
+        if tfile is not None and tfile.IsOpen():
+            self._files.move_to_end(key)
+            return tfile
+        tfile = ROOT.TFile.Open(rfilename)
+        if tfile is None or tfile.IsZombie():
+            raise OSError('Cannot open TFile {}'.format(rfilename))
+        self._files[key] = tfile
+        while len(self._files) > self.max_open:
+            self._close(self._files.popitem(last=False)[1])
+        return tfile
+
+    @staticmethod
+    def _close(tfile):
+        if tfile.IsOpen():
+            drop_key_index(tfile)
+        tfile.Close()
+
+    def get_tree(self, rfilename, treename='tree'):
+        return get_tree(self.get(rfilename), treename)
+
+    def close(self, rfilename):
+        tfile = self._files.pop(self._key(rfilename), None)
+        if tfile is not None:
+            self._close(tfile)
+        return None
+
+    def close_all(self):
+        while self._files:
+            self._close(self._files.popitem()[1])
+        return None
+
+    def __contains__(self, rfilename):
+        return self._key(rfilename) in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close_all()
+        return False
+
+_POOL = None
+
+def get_pool(max_open=None):
+    ''' Shared pool of the library functions below. '''
+    global _POOL
+    if _POOL is None:
+        _POOL = TFilePool() if max_open is None else TFilePool(max_open)
+    elif max_open is not None:
+        _POOL.max_open = max_open
+    return _POOL
+
+def inspect(rfilename, pool=None):
+    ''' Key metadata of every object in the file, see walk_key_infos. '''
+    return walk_key_infos((pool or get_pool()).get(rfilename))
+
+def list_branches(rfilename, treename='tree', pool=None):
+    ''' Name, type and entries of each branch of the tree. '''
+    return tree_info((pool or get_pool()).get_tree(rfilename,
+        treename))['branches']
+
+def count_entries(rfilename, treename='tree', pool=None):
+    return int((pool or get_pool()).get_tree(rfilename,
+        treename).GetEntries())
+
+def downsample(rfilename, outfilename, treename='tree', events=None,
+    fraction=0.1, save_treename='tree', columns=None, align_clusters=False,
+    write_options=None, pool=None):
+    ''' Writes the first events entries (default fraction of the tree) of
+    treename to outfilename. Returns the number of entries written. '''
+    tfile = (pool or get_pool()).get(rfilename)
+    treename = resolve_tree(tfile, treename)
+    tree = tfile.Get(treename)
+    nentries = int(tree.GetEntries())
+    if events is None:
+        events = int(fraction * nentries)
+    if events > nentries:
+        raise ValueError('Requested too many events, total of {} in file.'\
+            .format(nentries))
+    if align_clusters:
+        events = cluster_aligned_end(tree, events)
+    df = range_dataframe(treename, rfilename, events, tree=tree)
+    if columns is None:
+        columns = df.GetColumnNames()
+    df.Snapshot(save_treename, outfilename, columns,
+        snapshot_options(**(write_options or dict())))
+    return events
+
+def rename(rfilename, outfilename, treename, renames, keep=(), casts=None,
+    fast_clone=True, write_options=None, pool=None):
+    ''' Writes the branches of keep and renames (old -> new) to outfilename,
+    see rename_tree. Returns the method used and the fallback reason. '''
+    tfile = (pool or get_pool()).get(rfilename)
+    treename = resolve_tree(tfile, treename)
+    return rename_tree(tfile.Get(treename), outfilename, treename, renames,
+        keep, casts, fast_clone, write_options)
@@ -0,0 +1,155 @@
+#!/bin/bash
+#!/cvmfs/sft.cern.ch/lcg/views/LCG_101_ATLAS_26/x86_64-centos7-gcc11-opt/bin/python
+
+'''
+Script to time check_rootfiles, split_trees and rename_objects on generated
+test files. Records wall time, events/s, peak RSS and bytes read per case.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import argparse, sys, os, json, time, subprocess, tempfile, shutil
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+## FUNCTIONS ##
+def script(name):
+    return [sys.executable, os.path.join(HERE, name)]
+
+def read_proc_io(pid):
+    ''' Bytes read by pid so far (rchar, includes the page cache). '''
+    try:
+        with open('/proc/{}/io'.format(pid)) as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def run_case(cmd, log):
+    ''' Runs cmd and returns wall time, peak RSS and bytes read. rchar is
+    polled while the process runs, so it is a lower bound. '''
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+        stdin=subprocess.DEVNULL)
+    rchar = 0
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        rchar = read_proc_io(proc.pid) or rchar
+        time.sleep(0.02)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return dict(
+        returncode = proc.returncode,
+        wall_time = wall,
+        peak_rss_mb = rusage.ru_maxrss / 1024.,
+        read_bytes = rchar,
+        block_input_bytes = rusage.ru_inblock * 512)
+
+
+## ARGPARSING ##
+parser = argparse.ArgumentParser(
+                    prog = 'benchmark',
+                    description = 'Generate a test file and time the tools '\
+                    +'on it. Results are printed and optionally saved as '\
+                    +'JSON to compare between versions.')
+parser.add_argument('--entries', dest='entries', action='store',
+                    default=100000, type=int,
+                    help='Number of entries in the test file.')
+parser.add_argument('--seed', dest='seed', action='store',
+                    default=42, type=int,
+                    help='Random seed of the test file.')
+parser.add_argument('--tree-name', dest='tree_name', action='store',
+                    default='nominal/tree', type=str,
+                    help='Tree path in the test file.')
+parser.add_argument('--repeat', dest='repeat', action='store',
+                    default=3, type=int,
+                    help='Runs per case, the fastest one is reported.')
+parser.add_argument('--cases', dest='cases', action='store',
+                    default=None, type=str, nargs='+',
+                    help='Only run these cases.')
+parser.add_argument('--workdir', dest='workdir', action='store',
+                    default=None, type=str,
+                    help='Folder for the test file and outputs. Default is '\
+                    +'a temporary folder, removed afterwards.')
+parser.add_argument('--json-out', dest='json_out', action='store',
+                    default=None, type=str,
+                    help='Write the results to this JSON file.')
+args = parser.parse_intermixed_args()
+
+Entries = args.entries
+TreeName = args.tree_name
+WorkDir = args.workdir or tempfile.mkdtemp(prefix='rh_benchmark_')
+os.makedirs(WorkDir, exist_ok=True)
+TestFile = os.path.join(WorkDir, 'testfile_{}_{}.root'.format(Entries,
+    args.seed))
+OutDir = os.path.join(WorkDir, 'outputs')
+os.makedirs(OutDir, exist_ok=True)
+
+# (name, command, entries processed), writing cases --force so the repeats
+# are not skipped as up to date by the manifest
+Cases = [
+    ('check_nevents', script('check_rootfiles.py') + [TestFile,
+        '--get-nevents', '--tree-name', TreeName, '--no-cache'], Entries),
+    ('check_list_content', script('check_rootfiles.py') + [TestFile,
+        '--list-content', '--no-cache'], Entries),
+    ('check_branch_sizes', script('check_rootfiles.py') + [TestFile,
+        '--branch-sizes', '--tree-name', TreeName, '--no-cache'], Entries),
+    ('split_10pc', script('split_trees.py') + [TestFile, '--treename',
+        TreeName, '--savefolder', OutDir, '--filename', 'split_10pc',
+        '--no-multithreading', '--force'], Entries // 10),
+    ('split_3_shards', script('split_trees.py') + [TestFile, '--treename',
+        TreeName, '--savefolder', OutDir, '--filename', 'shards',
+        '--shards', '3', '--force'], Entries),
+    ('rename_r21_to_r22', script('rename_objects.py') + [TestFile,
+        '--tree-name', TreeName, '--mapping',
+        os.path.join(HERE, 'mappings', 'r21_to_r22.txt'), '--savefolder',
+        OutDir, '--yes', '--force'], Entries),
+]
+if args.cases is not None:
+    Cases = [case for case in Cases if case[0] in args.cases]
+
+
+## MAIN ##
+print('\n'+'-'*80)
+print('-- Benchmarking in: {}'.format(WorkDir))
+print('-'*80+'\n')
+
+if not os.path.exists(TestFile):
+    subprocess.run(script('generate_testfile.py') + [TestFile, '--entries',
+        str(Entries), '--seed', str(args.seed), '--tree-name', TreeName],
+        check=True)
+
+Results = []
+with open(os.path.join(WorkDir, 'benchmark.log'), 'w') as log:
+    for name, cmd, nevents in Cases:
+        runs = [run_case(cmd, log) for i in range(args.repeat)]
+        best = min(runs, key=lambda r: r['wall_time'])
+        best.update(case=name, command=' '.join(cmd), events=nevents,
+            events_per_s=nevents / best['wall_time'],
+            failed_runs=sum(r['returncode'] != 0 for r in runs))
+        Results.append(best)
+
+print('{:>20s} | {:>9s} | {:>12s} | {:>10s} | {:>11s} | {:>6s}'.format(
+    'Case', 'Wall (s)', 'Events/s', 'RSS (MB)', 'Read (MB)', 'Failed'))
+print('-'*84)
+for result in Results:
+    print('{:>20s} | {:>9.2f} | {:>12.0f} | {:>10.1f} | {:>11.1f} | {:>6d}'\
+        .format(result['case'], result['wall_time'], result['events_per_s'],
+        result['peak_rss_mb'], result['read_bytes'] / 1e6,
+        result['failed_runs']))
+print()
+
+if args.json_out is not None:
+    with open(args.json_out, 'w') as f:
+        json.dump(dict(entries=Entries, seed=args.seed, tree=TreeName,
+            file_size=os.path.getsize(TestFile), results=Results), f,
+            indent=2)
+    print('Saved results to {}\n'.format(args.json_out))
+if args.workdir is None:
+    shutil.rmtree(WorkDir)
+sys.exit(1 if any(r['failed_runs'] for r in Results) else 0)
@@ -9,22 +9,17 @@ author: Russell Bate
 email: russell.bate@cern.ch, russellbate@phas.ubc.ca
 '''
 
-import argparse, sys, os
-import ROOT
+import argparse, sys, os, json, re
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from utils import print_obj_info, inspect_keys
+from utils import open_rfile, print_obj_info, inspect_keys, \
+    print_key_info, is_directory_key, walk_key_infos, get_tree, tree_info, \
+    resolve_tree, expand_paths, survey_file, schema_summary, branch_sizes, \
+    count_entries_many, branch_type, is_histogrammable, sampled_ranges, \
+    branch_histograms, AmbiguousTreeError
+from metacache import MetadataCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_MB
 
 ## FUNCTIONS ##
-def open_rfile(rfilename):
-    ''' Handles error if opening fails (In python OSError) 
-    returns None if ROOT cannot open the file. '''
-    try:
-        f = ROOT.TFile.Open(rfilename)
-        return f
-    except OSError as ose:
-        print('Caught OSError: \n{} \n'.format(ose))
-        return None
-
 def inspect_rootfile(rootfile, keys=True, obj=True, rootmap=True):
     TFile = open_rfile(rootfile)
 
@@ -63,160 +58,395 @@ def inspect_rootfile(rootfile, keys=True, obj=True, rootmap=True):
     return None
 
 
-## ARGPARSING ##
-parser = argparse.ArgumentParser(
-                    prog = 'check_rootfiles', #epilog = ''
-                    description = 'Helpful root utilities with the pyROOT '\
-                    +'interface. Also contains useful functions.') 
-parser.add_argument('rootfile', # positional argument
-                    help='ROOT file to investigate.')
-parser.add_argument('--interactive', dest='interactive', action='store_true',
-                    default=False,
-                    help='Prompts for user input.')
-parser.add_argument('--list-content', dest='list_content', action='store_true',
-                    default=False,
-                    help='Show all content within root file.')
-parser.add_argument('--full-inspect', dest='inspect',
-                    action='store_true',
-                    help='Calls inspect_rootfile function. Unfinished.')
-
-tree_group = parser.add_argument_group('tree_group')
-
-tree_group.add_argument('--list-branches', dest='list_branches', action='store_true',
-                    default=False,
-                    help='List branches in tree. Can specify tree name.')
-tree_group.add_argument('--show-branch-type', dest='show_branch_type',
-                    action='store_true', default=False,
-                    help='Show branch data type listed in --list-branches.')
-tree_group.add_argument('--branch-events', dest='branch_events', action='store_true',
-                    default=False,
-                    help='Get the number of events in each branch.')
-tree_group.add_argument('--get-nevents', dest='get_nevents', action='store_true',
-                    default=False,
-                    help='Simply get the number of events in the tree.')
-tree_group.add_argument('--tree-name', dest='tree_name', action='store',
-                    default='tree', type=str,
-                    help='Name of which tree to inspect. Supports nested '\
-                    +'argument if a directory is present, i.e. dir/tname.')
-hist_group = parser.add_argument_group('hist_group')
-hist_group.add_argument('--draw-histogram', dest='check_histogram',
-                    action='store_true',
-                    help='Draws given histogram. Unfinished.')
-hist_group.add_argument('--hist-name', dest='hist_name', action='store',
-                    default=None, type=str,
-                    help='Name of histogram to draw. Unfinished.')
-hist_group.add_argument('--save-hist', dest='save_hist', action='store_true',
-                    default=False,
-                    help='Save drawn histogram. Unfinished.')
-
-args = parser.parse_intermixed_args()
-
-Interactive = args.interactive
-ListContent = args.list_content
-Inspect = args.inspect
-ListBranches = args.list_branches
-TreeName = args.tree_name
-CheckHistogram = args.check_histogram
-HistName = args.hist_name
-SaveHist = args.save_hist
-RootFile = args.rootfile
-GetNEvents = args.get_nevents
-ShowBranchType = args.show_branch_type
-BranchEvents = args.branch_events
-
-## MAIN ##
-print('\n'+'-'*80)
-print('-- Inspecting ROOT file: {}'.format(RootFile))
-print('-'*80+'\n')
-
-
-TFile = open_rfile(RootFile)
-if TFile is None:
-    sys.exit('\nCannot open TFile, exiting program..\n')
-RootFileName = Path(RootFile).name
-RootFileParent = Path(RootFile).parent
-
-key_list = TFile.GetListOfKeys() 
-if ListContent:
-    print('Listing content:')
-    print('Number of objects in file: {}'.format(len(key_list)))
-
-    for j, key in enumerate(key_list):
-        obj = key.ReadObj()
-        print('\nkey: {}'.format(j))
-        print_obj_info(obj, key, nspc=4)
-        if obj.ClassName() == 'TDirectoryFile':
-            inspect_keys(obj.GetListOfKeys(), nspc=6)
-    print()
-        
-if ListBranches:
-    print('Showing Branches for tree name: {}'.format(TreeName))
-    
-    if len(TreeName.split('/')) > 2:
-        raise ValueError('Nesting of trees beyond depth of 2 not supported'\
-            +' (yet): {}.'.format(Treename))
-    
-    try:
-        if '/' in TreeName:
-            TDirectory = TFile.GetKey(TreeName.split('/')[0]).ReadObj()
-            Tree = TDirectory.GetKey(TreeName.split('/')[1]).ReadObj()
+if __name__ == '__main__':
+    ## ARGPARSING ##
+    parser = argparse.ArgumentParser(
+                        prog = 'check_rootfiles', #epilog = ''
+                        description = 'Helpful root utilities with the pyROOT '\
+                        +'interface. Also contains useful functions.') 
+    parser.add_argument('rootfile', # positional argument
+                        nargs='+',
+                        help='ROOT file(s) to investigate. Accepts glob patterns, '\
+                        +'directories and @filelist text files. More than one '\
+                        +'file runs the batch mode.')
+    parser.add_argument('--interactive', dest='interactive', action='store_true',
+                        default=False,
+                        help='Prompts for user input.')
+    parser.add_argument('--list-content', dest='list_content', action='store_true',
+                        default=False,
+                        help='Show all content within root file.')
+    parser.add_argument('--read-objects', dest='read_objects', action='store_true',
+                        default=False,
+                        help='Read every object when listing content instead of '\
+                        +'using the key metadata only. Slow for large trees.')
+    parser.add_argument('--full-inspect', dest='inspect',
+                        action='store_true',
+                        help='Calls inspect_rootfile function. Unfinished.')
+
+    tree_group = parser.add_argument_group('tree_group')
+
+    tree_group.add_argument('--list-branches', dest='list_branches', action='store_true',
+                        default=False,
+                        help='List branches in tree. Can specify tree name.')
+    tree_group.add_argument('--show-branch-type', dest='show_branch_type',
+                        action='store_true', default=False,
+                        help='Show branch data type listed in --list-branches.')
+    tree_group.add_argument('--branch-events', dest='branch_events', action='store_true',
+                        default=False,
+                        help='Get the number of events in each branch.')
+    tree_group.add_argument('--get-nevents', dest='get_nevents', action='store_true',
+                        default=False,
+                        help='Simply get the number of events in the tree.')
+    tree_group.add_argument('--branch-sizes', dest='branch_sizes',
+                        action='store_true', default=False,
+                        help='Show compressed/uncompressed size, compression '\
+                        +'ratio and baskets of each branch and the tree '\
+                        +'clustering and compression.')
+    tree_group.add_argument('--sort-by', dest='sort_by', action='store',
+                        default='compressed', type=str,
+                        choices=['name', 'compressed', 'uncompressed', 'ratio',
+                        'baskets', 'avg_basket'],
+                        help='Column to sort --branch-sizes by. Default is '\
+                        +'compressed size, largest first.')
+    tree_group.add_argument('--json-out', dest='json_out', action='store',
+                        default=None, type=str,
+                        help='Write the --branch-sizes report to this JSON file.')
+    tree_group.add_argument('--tree-name', dest='tree_name', action='store',
+                        default='tree', type=str,
+                        help='Name of which tree to inspect. Supports nested '\
+                        +'paths of any depth, i.e. dir/subdir/tname, or the '\
+                        +'name of a unique tree anywhere in the file.')
+    hist_group = parser.add_argument_group('hist_group')
+    hist_group.add_argument('--draw-histogram', dest='check_histogram',
+                        action='store_true',
+                        help='Draws the histogram given by --hist-name, or '\
+                        +'histograms of the branches of --tree-name selected by '\
+                        +'--hist-branches/--hist-regex (default all numeric '\
+                        +'branches), filled in one pass. Saved as PNGs.')
+    hist_group.add_argument('--hist-name', dest='hist_name', action='store',
+                        default=None, type=str,
+                        help='Name (path) of a histogram in the file to draw.')
+    hist_group.add_argument('--save-hist', dest='save_hist', action='store_true',
+                        default=False,
+                        help='Also save the branch histograms to histograms.root.')
+    hist_group.add_argument('--hist-branches', dest='hist_branches',
+                        action='store', default=None, type=str, nargs='+',
+                        help='Branches to histogram.')
+    hist_group.add_argument('--hist-regex', dest='hist_regex', action='store',
+                        default=None, type=str,
+                        help='Histogram the branches matching this regex.')
+    hist_group.add_argument('--bins', dest='bins', action='store',
+                        default=50, type=int,
+                        help='Number of bins of the branch histograms.')
+    hist_group.add_argument('--sample-entries', dest='sample_entries',
+                        action='store', default=10000, type=int,
+                        help='Entries of the pre-pass deriving the binning.')
+    hist_group.add_argument('--hist-folder', dest='hist_folder', action='store',
+                        default='histograms', type=str,
+                        help='Folder for the PNGs and histograms.root.')
+    hist_group.add_argument('--threads', dest='threads', action='store',
+                        default=os.cpu_count(), type=int,
+                        help='Threads of the histogram event loop, 0 or 1 '\
+                        +'disables multithreading.')
+
+    batch_group = parser.add_argument_group('batch_group')
+    batch_group.add_argument('--json', dest='json', action='store_true',
+                        default=False,
+                        help='Run the batch mode even for one file: print one '\
+                        +'JSON record per file and a dataset summary.')
+    batch_group.add_argument('--jobs', dest='jobs', action='store',
+                        default=os.cpu_count(), type=int,
+                        help='Number of worker processes in batch mode.')
+    batch_group.add_argument('--output', dest='output', action='store',
+                        default=None, type=str,
+                        help='Also write the JSON records to this file.')
+
+    cache_group = parser.add_argument_group('cache_group')
+    cache_group.add_argument('--no-cache', dest='use_cache', action='store_false',
+                        default=True,
+                        help='Do not consult or fill the metadata cache.')
+    cache_group.add_argument('--refresh-cache', dest='refresh_cache',
+                        action='store_true', default=False,
+                        help='Ignore the cached record of this file and rebuild it.')
+    cache_group.add_argument('--clear-cache', dest='clear_cache',
+                        action='store_true', default=False,
+                        help='Remove all cached records before running.')
+    cache_group.add_argument('--cache-dir', dest='cache_dir', action='store',
+                        default=DEFAULT_CACHE_DIR, type=str,
+                        help='Metadata cache folder. Default is {}.'.format(
+                        DEFAULT_CACHE_DIR))
+    cache_group.add_argument('--cache-max-mb', dest='cache_max_mb',
+                        action='store', default=DEFAULT_MAX_MB, type=float,
+                        help='Size limit of the metadata cache in MB.')
+
+    args = parser.parse_intermixed_args()
+
+    Interactive = args.interactive
+    ListContent = args.list_content
+    ReadObjects = args.read_objects
+    Inspect = args.inspect
+    ListBranches = args.list_branches
+    TreeName = args.tree_name
+    CheckHistogram = args.check_histogram
+    HistName = args.hist_name
+    SaveHist = args.save_hist
+    RootFiles = expand_paths(args.rootfile)
+    GetNEvents = args.get_nevents
+    ShowBranchType = args.show_branch_type
+    BranchEvents = args.branch_events
+    BranchSizes = args.branch_sizes
+    SortBy = args.sort_by
+    JsonOut = args.json_out
+    UseCache = args.use_cache
+    RefreshCache = args.refresh_cache
+
+    Cache = None
+    if UseCache:
+        Cache = MetadataCache(args.cache_dir, args.cache_max_mb)
+        if args.clear_cache:
+            Cache.clear()
+        elif RefreshCache:
+            for rfile in RootFiles:
+                Cache.invalidate(rfile)
+
+    if len(RootFiles) == 0:
+        sys.exit('\nNo ROOT files matched {}, exiting program..\n'.format(
+            args.rootfile))
+
+    ## BATCH ##
+    if args.json or len(RootFiles) > 1:
+        OutFile = open(args.output, 'w') if args.output is not None else None
+        def emit(record):
+            line = json.dumps(record)
+            print(line, flush=True)
+            if OutFile is not None:
+                OutFile.write(line+'\n')
+
+        Results = []
+        if GetNEvents and not (ListContent or ListBranches):
+            # only the entry counts are needed, skip the branch survey
+            for result in count_entries_many(RootFiles, TreeName,
+                jobs=max(1, args.jobs), use_cache=UseCache,
+                cache_dir=args.cache_dir, cache_max_mb=args.cache_max_mb):
+                Results.append(result)
+                emit(result)
         else:
-            Tree = TFile.GetKey("{}".format(TreeName)).ReadObj()
-        Branches = Tree.GetListOfBranches()
-        print('Number of branches in file: {}\n'.format(len(Branches)))
- 
-        if BranchEvents:
-            print('\t{:>32s}  |  Number in Branch'.format('Branch'))
-            print('-'*80)
-            for branch in Branches:
-
-                branchname = str(branch.GetFullName())
-                branchentries = branch.GetEntries()
-
-                print('\t{:>32s}  |  {}  '.format(branchname, branchentries))
-                
-                if ShowBranchType:
-                    BranchClassName = branch.GetClassName()
-                    if BranchClassName == '':
-                        print(' '*8+'{}'.format(type(branch.GetFirstEntry())))
-                    else:
-                        print(' '*8+'{}'.format(BranchClassName))
+            with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+                futures = [pool.submit(survey_file, rfile, TreeName,
+                    list_content=ListContent, use_cache=UseCache,
+                    cache_dir=args.cache_dir, cache_max_mb=args.cache_max_mb)
+                    for rfile in RootFiles]
+                for future in as_completed(futures):
+                    Results.append(future.result())
+                    emit(Results[-1])
+        emit(dict(summary=schema_summary(Results)))
+        if OutFile is not None:
+            OutFile.close()
+        sys.exit(0 if all(r['ok'] for r in Results) else 1)
+
+    RootFile = RootFiles[0]
+
+    ## MAIN ##
+    print('\n'+'-'*80)
+    print('-- Inspecting ROOT file: {}'.format(RootFile))
+    print('-'*80+'\n')
+
+    RootFileName = Path(RootFile).name
+    RootFileParent = Path(RootFile).parent
+    Record = Cache.get(RootFile) if Cache is not None else None
+    if Record is None:
+        Record = dict()
+    TFile = None
+
+    def get_tfile():
+        ''' Opens the file the first time it is needed. '''
+        global TFile
+        if TFile is None:
+            TFile = open_rfile(RootFile)
+            if TFile is None or TFile.IsZombie():
+                sys.exit('\nCannot open TFile, exiting program..\n')
+        return TFile
+
+    def cache_put(**fields):
+        if Cache is not None:
+            Cache.put(RootFile, uuid=str(get_tfile().GetUUID().AsString()),
+                **fields)
+        Record.update(fields)
+
+    def get_tree_record(treename):
+        ''' Tree metadata from the cache, otherwise read from the file. Returns
+        None if the tree does not exist. '''
+        if treename in Record.get('trees', {}):
+            return Record['trees'][treename]
+        try:
+            Tree = get_tree(get_tfile(), treename)
+        except AmbiguousTreeError as err:
+            print('{}\n'.format(err))
+            return None
+        except ReferenceError as re:
+            print('TFile.GetKey({})'.format(treename))
+            print('Returned a null pointer. Tree with name {}'.format(treename))
+            print('does not exist in file {}\n'.format(RootFileName))
+            return None
+        record = tree_info(Tree)
+        cache_put(trees={treename: record})
+        return record
+
+    if ListContent:
+        print('Listing content:')
+        if ReadObjects:
+            key_list = get_tfile().GetListOfKeys()
+            print('Number of objects in file: {}'.format(len(key_list)))
+            for j, key in enumerate(key_list):
+                obj = key.ReadObj()
+                print('\nkey: {}'.format(j))
+                print_obj_info(obj, key, nspc=4)
+                if is_directory_key(key):
+                    tdir = get_tfile().GetDirectory(key.GetName())
+                    inspect_keys(tdir.GetListOfKeys(), nspc=6, read_obj=True,
+                        tdir=tdir, path=str(key.GetName()))
         else:
-            for branch in Branches:
-                print('    {}'.format(branch.GetFullName()))
-                if ShowBranchType:
-                    BranchClassName = branch.GetClassName()
-                    if BranchClassName == '':
-                        print(' '*8+'{}'.format(type(branch.GetFirstEntry())))
-                    else:
-                        print(' '*8+'{}'.format(BranchClassName))
-        
+            if 'keys' not in Record:
+                cache_put(keys=walk_key_infos(get_tfile()))
+            top_keys = [info for info in Record['keys'] if info['depth'] == 0]
+            print('Number of objects in file: {}'.format(len(top_keys)))
+            j = 0
+            for info in Record['keys']:
+                if info['depth'] == 0:
+                    print('\nkey: {}'.format(j))
+                    print_key_info(info, nspc=4)
+                    j += 1
+                else:
+                    print_key_info(info, nspc=4+2*info['depth'])
         print()
 
-    except ReferenceError as re:
-        print('TFile.GetKey({})'.format(TreeName))
-        print('Returned a null pointer. Tree with name {}'.format(TreeName))
-        print('does not exist in file {}\n'.format(RootFileName))
+    if ListBranches:
+        print('Showing Branches for tree name: {}'.format(TreeName))
+        TreeRecord = get_tree_record(TreeName)
+        if TreeRecord is not None:
+            Branches = TreeRecord['branches']
+            print('Number of branches in file: {}\n'.format(len(Branches)))
 
-if GetNEvents:
-    print('Showing number of events for tree name: {}'.format(TreeName))
+            if BranchEvents:
+                print('\t{:>32s}  |  Number in Branch'.format('Branch'))
+                print('-'*80)
+                for branch in Branches:
+                    print('\t{:>32s}  |  {}  '.format(branch['name'],
+                        branch['entries']))
+                    if ShowBranchType:
+                        print(' '*8+'{}'.format(branch['type']))
+            else:
+                for branch in Branches:
+                    print('    {}'.format(branch['name']))
+                    if ShowBranchType:
+                        print(' '*8+'{}'.format(branch['type']))
 
-    if len(TreeName.split('/')) > 2:
-        raise ValueError('Nesting of trees beyond depth of 2 not supported'\
-            +' (yet): {}.'.format(Treename))
+            print()
 
-    try:
-        if '/' in TreeName:
-            TDirectory = TFile.GetKey(TreeName.split('/')[0]).ReadObj()
-            Tree = TDirectory.GetKey(TreeName.split('/')[1]).ReadObj()
+    if GetNEvents:
+        print('Showing number of events for tree name: {}'.format(TreeName))
+        TreeRecord = get_tree_record(TreeName)
+        if TreeRecord is not None:
+            print('Number of entries in file: {}\n'.format(TreeRecord['entries']))
+
+    if BranchSizes:
+        print('Showing branch sizes for tree name: {}'.format(TreeName))
+        SizeRecord = Record.get('branch_sizes', {}).get(TreeName)
+        if SizeRecord is None:
+            try:
+                Tree = get_tree(get_tfile(), TreeName)
+                SizeRecord = branch_sizes(Tree)
+                cache_put(branch_sizes={TreeName: SizeRecord})
+            except AmbiguousTreeError as err:
+                print('{}\n'.format(err))
+            except ReferenceError as err:
+                print('TFile.GetKey({})'.format(TreeName))
+                print('Returned a null pointer. Tree with name {}'.format(TreeName))
+                print('does not exist in file {}\n'.format(RootFileName))
+        if SizeRecord is not None:
+            compression = SizeRecord['compression']
+            print('Entries: {}'.format(SizeRecord['entries']))
+            print('Size: {} (compressed), {} (uncompressed), ratio {:.2f}'.format(
+                SizeRecord['compressed'], SizeRecord['uncompressed'],
+                SizeRecord['ratio']))
+            print('Clusters: {}, average {:.1f} entries, auto flush {}'.format(
+                SizeRecord['clusters'], SizeRecord['avg_cluster_entries'],
+                SizeRecord['autoflush']))
+            if compression is not None:
+                print('Compression: {} level {} ({})\n'.format(
+                    compression['algorithm'], compression['level'],
+                    compression['settings']))
+
+            Rows = sorted(SizeRecord['branches'], key=lambda b: b[SortBy],
+                reverse=SortBy != 'name')
+            print('{:>32s} | {:>12s} | {:>12s} | {:>6s} | {:>7s} | {:>10s}'.format(
+                'Branch', 'Compressed', 'Uncompressed', 'Ratio', 'Baskets',
+                'Avg basket'))
+            print('-'*94)
+            for row in Rows:
+                print('{:>32s} | {:>12d} | {:>12d} | {:>6.2f} | {:>7d} | {:>10.0f}'\
+                    .format(row['name'], row['compressed'], row['uncompressed'],
+                    row['ratio'], row['baskets'], row['avg_basket']))
+            print()
+
+            if JsonOut is not None:
+                with open(JsonOut, 'w') as f:
+                    json.dump(dict(SizeRecord, file=RootFile, tree=TreeName,
+                        branches=Rows), f, indent=2)
+                print('Saved report to {}\n'.format(JsonOut))
+
+    if CheckHistogram:
+        import ROOT
+        ROOT.gROOT.SetBatch(True)
+        os.makedirs(args.hist_folder, exist_ok=True)
+        Canvas = ROOT.TCanvas('canvas', 'canvas', 800, 600)
+
+        def save_png(hist, name):
+            hist.Draw('hist')
+            pngname = os.path.join(args.hist_folder, '{}.png'.format(
+                name.replace('/', '_')))
+            Canvas.SaveAs(pngname)
+            return pngname
+
+        if HistName is not None:
+            print('Drawing histogram: {}'.format(HistName))
+            Hist = get_tfile().Get(HistName)
+            if not Hist or not Hist.InheritsFrom('TH1'):
+                print('No histogram with name {} in file {}\n'.format(HistName,
+                    RootFileName))
+            else:
+                print('Saved {}\n'.format(save_png(Hist, HistName)))
         else:
-            Tree = TFile.GetKey("{}".format(TreeName)).ReadObj()
-        
-        Entries = Tree.GetEntries()
-        print('Number of entries in file: {}\n'.format(Entries))
-    
-    except ReferenceError as re:
-        print('TFile.GetKey({})'.format(TreeName))
-        print('Returned a null pointer. Tree with name {}'.format(TreeName))
-        print('does not exist in file {}\n'.format(RootFileName))
+            print('Filling histograms for tree name: {}'.format(TreeName))
+            try:
+                TreePath = resolve_tree(get_tfile(), TreeName)
+            except ReferenceError as err:
+                sys.exit('{}\n'.format(err))
+            Tree = get_tfile().Get(TreePath)
+            Columns = [str(b.GetName()) for b in Tree.GetListOfBranches()
+                if is_histogrammable(branch_type(b))]
+            if args.hist_branches is not None:
+                Columns = [col for col in args.hist_branches if col in Columns]
+            if args.hist_regex is not None:
+                Columns = [col for col in Columns if re.search(args.hist_regex,
+                    col)]
+            print('Number of branches to histogram: {}'.format(len(Columns)))
+
+            # binning from a cheap single-threaded pre-pass, then one
+            # multithreaded pass fills every histogram
+            Ranges = sampled_ranges(Tree, Columns, args.sample_entries)
+            if args.threads > 1:
+                ROOT.EnableImplicitMT(args.threads)
+            Hists = branch_histograms(TreePath, RootFile, Ranges, args.bins)
 
+            for col, hist in Hists.items():
+                save_png(hist, col)
+            print('Saved {} PNGs to {}'.format(len(Hists), args.hist_folder))
+            if SaveHist:
+                HistFileName = os.path.join(args.hist_folder, 'histograms.root')
+                HistFile = ROOT.TFile.Open(HistFileName, 'RECREATE')
+                for hist in Hists.values():
+                    hist.Write()
+                HistFile.Close()
+                print('Saved histograms to {}'.format(HistFileName))
+            print()
@@ -0,0 +1,167 @@
+'''
+Command line options shared by the tools (Snapshot write options, read
+cache, run reports, manifest and branch selection) and the run report
+written with --report.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import os, sys, json, time, resource
+from collections import OrderedDict
+from contextlib import contextmanager
+import manifest
+from utils import SNAPSHOT_ALGORITHMS, read_stats
+
+
+## FUNCTIONS ##
+def add_snapshot_args(parser):
+    ''' Adds the Snapshot write options to an argparse parser. '''
+    group = parser.add_argument_group('snapshot_group')
+    group.add_argument('--compression-algorithm', dest='compression_algorithm',
+        action='store', default=None, type=str, choices=SNAPSHOT_ALGORITHMS,
+        help='Compression algorithm of the output. Default is ROOT\'s.')
+    group.add_argument('--compression-level', dest='compression_level',
+        action='store', default=None, type=int,
+        help='Compression level of the output (0-9).')
+    group.add_argument('--basket-size', dest='basket_size', action='store',
+        default=None, type=int,
+        help='Output basket size in bytes (ROOT >= 6.30).')
+    group.add_argument('--auto-flush', dest='auto_flush', action='store',
+        default=None, type=int,
+        help='Output auto flush, > 0 entries or < 0 bytes per cluster.')
+    return group
+
+def write_options_from_args(args):
+    ''' Snapshot write options given on the command line, None for the
+    ROOT defaults. '''
+    options = dict(algorithm=args.compression_algorithm,
+        level=args.compression_level, basket_size=args.basket_size,
+        autoflush=args.auto_flush)
+    return {name: value for name, value in options.items()
+        if value is not None}
+
+def add_tree_cache_args(parser):
+    ''' Adds the TTreeCache (read cache) options to an argparse parser. '''
+    group = parser.add_argument_group('tree_cache_group')
+    group.add_argument('--tree-cache-size', dest='tree_cache_size',
+        action='store', default=None, type=float,
+        help='TTreeCache size in MB. Default is ROOT\'s (one cluster).')
+    group.add_argument('--tree-cache-learn-entries',
+        dest='tree_cache_learn_entries', action='store', default=None,
+        type=int,
+        help='Entries read before the cache fixes its branch list.')
+    group.add_argument('--tree-cache-prefetch', dest='tree_cache_prefetch',
+        action='store_true',
+        help='Read the next cache block asynchronously.')
+    group.add_argument('--tree-cache-used-only',
+        dest='tree_cache_used_only', action='store_true',
+        help='Fill the cache with the used branches from the first entry '\
+        +'instead of learning them.')
+    return group
+
+def set_read_cache_env(args):
+    ''' Process wide cache settings, also used by the trees RDataFrame
+    opens itself in multithreaded loops. Call before opening files. '''
+    import ROOT
+    if args.tree_cache_prefetch:
+        ROOT.gEnv.SetValue('TFile.AsyncPrefetching', 1)
+    if args.tree_cache_learn_entries is not None:
+        ROOT.TTreeCache.SetLearnEntries(args.tree_cache_learn_entries)
+
+def add_report_args(parser):
+    ''' Adds the progress and run report options to an argparse parser. '''
+    group = parser.add_argument_group('report_group')
+    group.add_argument('--progress', dest='progress', action='store_true',
+        help='Print entries done, events/s and MB/s during event loops.')
+    group.add_argument('--report', dest='report', action='store',
+        default=None, type=str,
+        help='Write stage timings, throughput and peak memory to this '\
+        +'JSON file.')
+    return group
+
+class RunReport:
+    ''' Wall time of each stage, throughput and peak memory of one run of
+    a tool, saved as JSON. Stages entered twice are summed. '''
+    def __init__(self, tool, **fields):
+        self.data = dict(tool=tool, argv=sys.argv[1:], **fields)
+        self.data['stages'] = OrderedDict()
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.data['stages'][name] = self.data['stages'].get(name, 0.) \
+                + time.perf_counter() - start
+
+    def update(self, **fields):
+        self.data.update(fields)
+
+    def finish(self):
+        ''' Adds the totals: wall time, peak RSS of this process and its
+        workers, bytes read by TFiles and the event loop throughput. '''
+        data = self.data
+        data['wall_time'] = time.perf_counter() - self.start
+        data['peak_rss_mb'] = max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+        if 'ROOT' in sys.modules:
+            data.update(read_stats())
+        loop = data['stages'].get('event_loop')
+        if loop:
+            if 'entries' in data:
+                data['events_per_s'] = data['entries'] / loop
+            if 'bytes_read' in data:
+                data['read_mb_per_s'] = data['bytes_read'] / loop / 1e6
+        return data
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.finish(), f, indent=2)
+        print('Saved run report to {}\n'.format(path))
+
+def add_manifest_args(parser):
+    ''' Adds the incremental reprocessing options to an argparse parser. '''
+    group = parser.add_argument_group('manifest_group')
+    group.add_argument('--manifest', dest='manifest', action='store',
+        default=None, type=str,
+        help=('Manifest of the outputs, outputs recorded with the same '\
+        +'input and options are skipped. Default is {} in the save '\
+        +'folder.').format(manifest.DEFAULT_NAME))
+    group.add_argument('--force', dest='force', action='store_true',
+        help='Rewrite outputs even if they are up to date.')
+    return group
+
+def open_manifest(args, folder):
+    return manifest.Manifest(args.manifest or os.path.join(folder,
+        manifest.DEFAULT_NAME))
+
+# options that change how a tool runs, not what it writes
+_RUN_OPTIONS = {'progress', 'report', 'manifest', 'force', 'jobs', 'yes',
+    'verbose', 'rootfile', 'savefolder', 'tree_cache_size',
+    'tree_cache_learn_entries', 'tree_cache_prefetch', 'tree_cache_used_only'}
+
+def tool_options(args):
+    ''' Options of args which determine the content of the outputs, used
+    to tell whether an output is up to date. '''
+    return {name: value for name, value in sorted(vars(args).items())
+        if name not in _RUN_OPTIONS}
+
+def add_column_args(parser):
+    ''' Adds the branch selection options to an argparse parser. '''
+    group = parser.add_argument_group('column_group')
+    group.add_argument('--include', dest='include', action='store',
+        default=None, type=str, nargs='+',
+        help='Only keep these branches.')
+    group.add_argument('--include-regex', dest='include_regex',
+        action='store', default=None, type=str, nargs='+',
+        help='Only keep the branches fully matching these regexes.')
+    group.add_argument('--exclude', dest='exclude', action='store',
+        default=None, type=str, nargs='+',
+        help='Drop these branches.')
+    group.add_argument('--exclude-regex', dest='exclude_regex',
+        action='store', default=None, type=str, nargs='+',
+        help='Drop the branches fully matching these regexes.')
+    return group
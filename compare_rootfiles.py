@@ -0,0 +1,316 @@
+#!/bin/bash
+#!/cvmfs/sft.cern.ch/lcg/views/LCG_101_ATLAS_26/x86_64-centos7-gcc11-opt/bin/python
+
+'''
+Script to check that the tree of one ROOT file matches the tree of another:
+schema, entry counts and the content of every branch, following a rename
+mapping. Chunks of entries are hashed in parallel processes; only chunks with
+different hashes are compared entry by entry, with a numeric tolerance.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import argparse, sys, os, json, time, array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import open_rfile, get_tree, tree_info, parse_mapping, \
+    declare_cpp, LEAF_TYPES, AmbiguousTreeError
+
+# FNV-1a over the bytes of every value, vectors also hash their size
+HASH_CHUNK = """
+#include <vector>
+#include "TTree.h"
+#include "TTreeReader.h"
+#include "TTreeReaderValue.h"
+
+inline void rh_mix(ULong64_t &h, const void *data, std::size_t n)
+{
+    const unsigned char *p = static_cast<const unsigned char *>(data);
+    for (std::size_t i = 0; i < n; ++i) {
+        h ^= p[i];
+        h *= 1099511628211ULL;
+    }
+}
+
+template <typename T>
+void rh_hash_value(ULong64_t &h, const T &x)
+{
+    rh_mix(h, &x, sizeof(T));
+}
+
+template <typename T>
+void rh_hash_value(ULong64_t &h, const std::vector<T> &v)
+{
+    const ULong64_t n = v.size();
+    rh_mix(h, &n, sizeof(n));
+    for (std::size_t i = 0; i < v.size(); ++i) {
+        const T x = v[i]; // also works for vector<bool>
+        rh_hash_value(h, x);
+    }
+}
+
+template <typename T>
+ULong64_t rh_hash_chunk(TTree *tree, const char *branch, Long64_t begin,
+    Long64_t end)
+{
+    TTreeReader reader(tree);
+    TTreeReaderValue<T> value(reader, branch);
+    reader.SetEntriesRange(begin, end);
+    ULong64_t h = 14695981039346656037ULL;
+    while (reader.Next())
+        rh_hash_value(h, *value);
+    return h;
+}
+"""
+
+COMPARE_CHUNK = """
+#include <cmath>
+#include <vector>
+#include "TTree.h"
+#include "TTreeReader.h"
+#include "TTreeReaderValue.h"
+
+template <typename A, typename B>
+bool rh_close(const A &a, const B &b, double rtol, double atol)
+{
+    const double x = a, y = b;
+    if (std::isnan(x) || std::isnan(y))
+        return std::isnan(x) && std::isnan(y);
+    return std::abs(x - y) <= atol + rtol * std::abs(y);
+}
+
+template <typename A, typename B>
+bool rh_close(const std::vector<A> &a, const std::vector<B> &b, double rtol,
+    double atol)
+{
+    if (a.size() != b.size())
+        return false;
+    for (std::size_t i = 0; i < a.size(); ++i) {
+        const A x = a[i];
+        const B y = b[i];
+        if (!rh_close(x, y, rtol, atol))
+            return false;
+    }
+    return true;
+}
+
+template <typename A, typename B>
+Long64_t rh_compare_chunk(TTree *ta, const char *na, TTree *tb,
+    const char *nb, Long64_t begin, Long64_t end, double rtol, double atol,
+    Long64_t *first, Long64_t nfirst)
+{
+    TTreeReader ra(ta), rb(tb);
+    TTreeReaderValue<A> va(ra, na);
+    TTreeReaderValue<B> vb(rb, nb);
+    ra.SetEntriesRange(begin, end);
+    rb.SetEntriesRange(begin, end);
+    Long64_t nbad = 0;
+    while (ra.Next() && rb.Next()) {
+        if (!rh_close(*va, *vb, rtol, atol)) {
+            if (nbad < nfirst)
+                first[nbad] = ra.GetCurrentEntry();
+            ++nbad;
+        }
+    }
+    return nbad;
+}
+"""
+
+
+## FUNCTIONS ##
+def cpp_type(typename):
+    ''' C++ type read for a branch: numeric scalars and (nested) vectors of
+    them. None if the branch cannot be compared. '''
+    typename = typename.replace(' ', '').replace('std::', '')
+    if typename.startswith('vector<') and typename.endswith('>'):
+        inner = cpp_type(typename[len('vector<'):-1])
+        return None if inner is None else 'std::vector<{}>'.format(inner)
+    return LEAF_TYPES[typename][0] if typename in LEAF_TYPES else None
+
+def branch_pairs(branches_a, branches_b, renames=None, keep=(), casts=None,
+    only=None):
+    ''' Matches the branches of A to those of B. With renames (old -> new)
+    only the renamed and kept branches are expected in B. Returns the pairs
+    (name_a, name_b, cpp_a, cpp_b) and the schema differences. '''
+    types_a = {b['name']: b['type'] for b in branches_a}
+    types_b = {b['name']: b['type'] for b in branches_b}
+    casts = casts or dict()
+    if renames is None:
+        expected = [(name, name) for name in types_a]
+    else:
+        expected = list(renames.items()) + [(name, name) for name in keep]
+    if only is not None:
+        expected = [(a, b) for a, b in expected if a in only or b in only]
+
+    pairs, schema = [], dict(missing=[], retyped=[], unsupported=[])
+    for name_a, name_b in expected:
+        if name_a not in types_a or name_b not in types_b:
+            schema['missing'].append([name_a, name_b])
+            continue
+        cpp_a, cpp_b = cpp_type(types_a[name_a]), cpp_type(types_b[name_b])
+        if cpp_a is None or cpp_b is None:
+            schema['unsupported'].append([name_a, name_b])
+            continue
+        if cpp_a != cpp_b and name_b not in casts:
+            schema['retyped'].append([name_a, types_a[name_a],
+                name_b, types_b[name_b]])
+        if cpp_a.count('vector') != cpp_b.count('vector'):
+            # a cast cannot change the nesting, the values are not compared
+            if name_b in casts:
+                schema['unsupported'].append([name_a, name_b])
+            continue
+        pairs.append((name_a, name_b, cpp_a, cpp_b))
+    schema['extra'] = sorted(set(types_b) - set(b for a, b in expected))
+    return pairs, schema
+
+def compare_chunk(file_a, tree_a, file_b, tree_b, pairs, begin, end, rtol,
+    atol, max_report):
+    ''' Worker: compares the branch pairs over entries [begin, end). Equal
+    types are hashed first, the entries are only compared when the hashes
+    differ. Returns {name_a: (mismatches, first mismatching entries)}. '''
+    hash_chunk = declare_cpp('rh_hash_chunk', HASH_CHUNK)
+    compare = declare_cpp('rh_compare_chunk', COMPARE_CHUNK)
+    tfile_a, tfile_b = open_rfile(file_a), open_rfile(file_b)
+    ta, tb = get_tree(tfile_a, tree_a), get_tree(tfile_b, tree_b)
+    first = array.array('q', bytes(8 * max(1, max_report)))
+    result = dict()
+    for name_a, name_b, cpp_a, cpp_b in pairs:
+        if cpp_a == cpp_b and hash_chunk[cpp_a](ta, name_a, begin, end) == \
+            hash_chunk[cpp_b](tb, name_b, begin, end):
+            result[name_a] = (0, [])
+            continue
+        nbad = compare[cpp_a, cpp_b](ta, name_a, tb, name_b, begin, end,
+            rtol, atol, first, max_report)
+        result[name_a] = (int(nbad), list(first[:min(nbad, max_report)]))
+    tfile_a.Close()
+    tfile_b.Close()
+    return result
+
+
+if __name__ == '__main__':
+    ## ARGPARSING ##
+    parser = argparse.ArgumentParser(
+                        prog = 'compare_rootfiles',
+                        description = 'Compare the schema, entry counts and '\
+                        +'branch content of a tree in two ROOT files, e.g. '\
+                        +'the input and output of rename_objects. Exits '\
+                        +'with 1 if anything differs or cannot be compared.')
+    parser.add_argument('file_a', # positional argument
+                        help='Reference ROOT file.')
+    parser.add_argument('file_b', # positional argument
+                        help='ROOT file to check against the reference.')
+    parser.add_argument('--tree-name', dest='tree_name', action='store',
+                        default='tree', type=str,
+                        help='Name of the tree, i.e. tname or dir/tname.')
+    parser.add_argument('--tree-name-b', dest='tree_name_b', action='store',
+                        default=None, type=str,
+                        help='Name of the tree in file_b. Default is '\
+                        +'--tree-name.')
+    parser.add_argument('--mapping', dest='mapping', action='store',
+                        default=None, type=str,
+                        help='Branch mapping file used to rename file_a into '\
+                        +'file_b, see mappings/r21_to_r22.txt. Only the '\
+                        +'mapped branches are expected in file_b.')
+    parser.add_argument('--branches', dest='branches', action='store',
+                        default=None, type=str, nargs='+',
+                        help='Only compare these branches (either name).')
+    parser.add_argument('--rtol', dest='rtol', action='store',
+                        default=0., type=float,
+                        help='Relative tolerance of numeric values.')
+    parser.add_argument('--atol', dest='atol', action='store',
+                        default=0., type=float,
+                        help='Absolute tolerance of numeric values.')
+    parser.add_argument('--chunk-size', dest='chunk_size', action='store',
+                        default=500000, type=int,
+                        help='Entries per chunk.')
+    parser.add_argument('--max-report', dest='max_report', action='store',
+                        default=10, type=int,
+                        help='Number of mismatching entries listed per '\
+                        +'branch.')
+    parser.add_argument('--jobs', dest='jobs', action='store',
+                        default=os.cpu_count(), type=int,
+                        help='Number of worker processes.')
+    parser.add_argument('--json-out', dest='json_out', action='store',
+                        default=None, type=str,
+                        help='Write the results to this JSON file.')
+    args = parser.parse_intermixed_args()
+
+    TreeA = args.tree_name
+    TreeB = args.tree_name_b or args.tree_name
+
+    print('\n'+'-'*80)
+    print('-- Comparing: {}\n--      with: {}'.format(args.file_a,
+        args.file_b))
+    print('-'*80+'\n')
+    Start = time.perf_counter()
+
+    Infos = []
+    for rfilename, treename in [(args.file_a, TreeA), (args.file_b, TreeB)]:
+        tfile = open_rfile(rfilename)
+        if tfile is None:
+            sys.exit('\nCannot open TFile {}, exiting program..\n'.format(
+                rfilename))
+        try:
+            Infos.append(tree_info(get_tree(tfile, treename)))
+        except AmbiguousTreeError as err:
+            sys.exit('{}\n'.format(err))
+        except ReferenceError as err:
+            sys.exit('Tree with name {} does not exist in file {}\n'.format(
+                treename, rfilename))
+        tfile.Close()
+
+    Renames, Keep, Casts = None, (), dict()
+    if args.mapping is not None:
+        Renames, Keep, Casts = parse_mapping(args.mapping)
+    Pairs, Schema = branch_pairs(Infos[0]['branches'], Infos[1]['branches'],
+        Renames, Keep, Casts, args.branches)
+    EntriesA, EntriesB = Infos[0]['entries'], Infos[1]['entries']
+    Entries = min(EntriesA, EntriesB)
+
+    # every chunk compares all branches, so each worker reads whole clusters
+    Mismatches = {pair[0]: [0, []] for pair in Pairs}
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futures = [pool.submit(compare_chunk, args.file_a, TreeA,
+            args.file_b, TreeB, Pairs, begin,
+            min(begin + args.chunk_size, Entries), args.rtol, args.atol,
+            args.max_report)
+            for begin in range(0, Entries, args.chunk_size)]
+        for future in as_completed(futures):
+            for name, (nbad, first) in future.result().items():
+                Mismatches[name][0] += nbad
+                Mismatches[name][1] = sorted(Mismatches[name][1] + first)\
+                    [:args.max_report]
+    Wall = time.perf_counter() - Start
+
+    print('Entries: {} vs {}{}'.format(EntriesA, EntriesB,
+        '' if EntriesA == EntriesB else '  <== DIFFERENT'))
+    for kind in ['missing', 'retyped', 'unsupported']:
+        for item in Schema[kind]:
+            print('{:>12s}: {}'.format(kind, item))
+    if Schema['extra']:
+        print('{:>12s}: {}'.format('only in B', Schema['extra']))
+    print('\n{:>32s} | {:>32s} | {:>12s} | {}'.format('Branch A', 'Branch B',
+        'Mismatches', 'First entries'))
+    print('-'*100)
+    for name_a, name_b, cpp_a, cpp_b in Pairs:
+        nbad, first = Mismatches[name_a]
+        print('{:>32s} | {:>32s} | {:>12d} | {}'.format(name_a, name_b, nbad,
+            first if nbad else ''))
+    Different = [name for name, (nbad, first) in Mismatches.items() if nbad]
+    Failed = bool(Different or Schema['missing'] or Schema['retyped'] or
+        Schema['unsupported'] or EntriesA != EntriesB)
+    print('\n{} in {:.1f} s: {} of {} branches differ over {} entries\n'\
+        .format('DIFFERENT' if Failed else 'MATCH', Wall, len(Different),
+        len(Pairs), Entries))
+
+    if args.json_out is not None:
+        with open(args.json_out, 'w') as f:
+            json.dump(dict(file_a=args.file_a, file_b=args.file_b,
+                tree_a=TreeA, tree_b=TreeB, entries_a=EntriesA,
+                entries_b=EntriesB, schema=Schema, rtol=args.rtol,
+                atol=args.atol, wall_time=Wall, match=not Failed,
+                branches={name_a: dict(branch_b=name_b,
+                mismatches=Mismatches[name_a][0],
+                first_entries=Mismatches[name_a][1])
+                for name_a, name_b, cpp_a, cpp_b in Pairs}), f, indent=2)
+        print('Saved results to {}\n'.format(args.json_out))
+    sys.exit(1 if Failed else 0)
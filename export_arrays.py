@@ -0,0 +1,225 @@
+#!/bin/bash
+#!/cvmfs/sft.cern.ch/lcg/views/LCG_101_ATLAS_26/x86_64-centos7-gcc11-opt/bin/python
+
+'''
+Script to export tree branches to .npy files that can be memory-mapped.
+Scalar branches become one array, vector<T> branches an offsets array (one
+more than the number of entries) and a flat values array. Entries are
+streamed in chunks so memory use does not depend on the input size.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import argparse, sys, os, json, struct, time, array
+import numpy as np
+from utils import open_rfile, get_tree, AmbiguousTreeError, branch_type, \
+    declare_cpp, LEAF_TYPES
+
+# Both helpers append raw values to a file, so nothing of the size of the
+# input is ever held in memory.
+DUMP_SCALAR = """
+#include <cstdio>
+#include "TTree.h"
+#include "TTreeReader.h"
+#include "TTreeReaderValue.h"
+
+template <typename T>
+Long64_t rh_dump_scalar(TTree *tree, const char *branch, Long64_t begin,
+    Long64_t end, const char *path)
+{
+    TTreeReader reader(tree);
+    TTreeReaderValue<T> value(reader, branch);
+    reader.SetEntriesRange(begin, end);
+    FILE *out = std::fopen(path, "ab");
+    Long64_t n = 0;
+    while (reader.Next()) {
+        std::fwrite(&(*value), sizeof(T), 1, out);
+        ++n;
+    }
+    std::fclose(out);
+    return n;
+}
+"""
+
+DUMP_JAGGED = """
+#include <cstdio>
+#include <vector>
+#include "TTree.h"
+#include "TTreeReader.h"
+#include "TTreeReaderValue.h"
+
+template <typename T>
+Long64_t rh_dump_jagged(TTree *tree, const char *branch, Long64_t begin,
+    Long64_t end, Long64_t *counts, const char *path)
+{
+    TTreeReader reader(tree);
+    TTreeReaderValue<std::vector<T>> value(reader, branch);
+    reader.SetEntriesRange(begin, end);
+    FILE *out = std::fopen(path, "ab");
+    Long64_t n = 0;
+    while (reader.Next()) {
+        const std::vector<T> &v = *value;
+        if (!v.empty())
+            std::fwrite(v.data(), sizeof(T), v.size(), out);
+        counts[n++] = v.size();
+    }
+    std::fclose(out);
+    return n;
+}
+"""
+
+
+## FUNCTIONS ##
+class NpyAppender:
+    ''' 1D .npy file written by appending raw bytes. The header is reserved
+    with a fixed width and rewritten with the final length on close. '''
+    HEADER_LEN = 128
+
+    def __init__(self, path, dtype):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        with open(path, 'wb') as f:
+            f.write(self._header())
+
+    def _header(self):
+        text = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({:d},), }}"\
+            .format(np.lib.format.dtype_to_descr(self.dtype), self.length)
+        # magic (6) + version (2) + header length (2) + padded text
+        text = text.ljust(self.HEADER_LEN - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(text)) + \
+            text.encode('latin1')
+
+    def append(self, data):
+        with open(self.path, 'ab') as f:
+            f.write(np.ascontiguousarray(data, dtype=self.dtype).tobytes())
+        self.length += len(data)
+
+    def close(self):
+        with open(self.path, 'r+b') as f:
+            f.write(self._header())
+
+def export_branch(tree, branch, outdir, chunk_size):
+    ''' Streams one branch to outdir in chunks of chunk_size entries.
+    Returns the manifest entry of the branch. Raises TypeError if the
+    branch does not exist or its type cannot be exported. '''
+    tbranch = tree.GetBranch(branch)
+    if not tbranch:
+        raise TypeError('Branch {} is not in the tree.'.format(branch))
+    typename = branch_type(tbranch).replace(' ', '')
+    nentries = int(tree.GetEntries())
+    jagged = typename.startswith('vector<')
+    inner = typename[len('vector<'):-1] if jagged else typename
+    # vector<bool> has no contiguous data() for the jagged dump
+    if inner not in LEAF_TYPES or (jagged and LEAF_TYPES[inner][0] == 'bool'):
+        raise TypeError('Branch {} of type {} cannot be exported.'.format(
+            branch, typename))
+    ctype, dtype = LEAF_TYPES[inner]
+
+    if not jagged:
+        values = NpyAppender(os.path.join(outdir, branch+'.npy'), dtype)
+        dump = declare_cpp('rh_dump_scalar', DUMP_SCALAR)[ctype]
+        for begin in range(0, nentries, chunk_size):
+            end = min(begin + chunk_size, nentries)
+            # the helper writes behind the header, only the length is tracked
+            values.length += dump(tree, branch, begin, end, values.path)
+        values.close()
+        return dict(name=branch, type=typename, layout='scalar',
+            values=branch+'.npy', dtype=dtype)
+
+    offsets = NpyAppender(os.path.join(outdir, branch+'.offsets.npy'), '<i8')
+    values = NpyAppender(os.path.join(outdir, branch+'.values.npy'), dtype)
+    offsets.append(np.zeros(1, dtype='<i8'))
+    dump = declare_cpp('rh_dump_jagged', DUMP_JAGGED)[ctype]
+    # 'q' is exactly Long64_t, the buffer is reused for every chunk
+    counts = array.array('q', bytes(8 * chunk_size))
+    for begin in range(0, nentries, chunk_size):
+        end = min(begin + chunk_size, nentries)
+        n = dump(tree, branch, begin, end, counts, values.path)
+        chunk_offsets = np.cumsum(np.frombuffer(counts, dtype=np.int64,
+            count=n)) + values.length
+        values.length = int(chunk_offsets[-1]) if n > 0 else values.length
+        offsets.append(chunk_offsets)
+    offsets.close()
+    values.close()
+    return dict(name=branch, type=typename, layout='jagged',
+        offsets=branch+'.offsets.npy', values=branch+'.values.npy',
+        dtype=dtype)
+
+def load_arrays(outdir, mmap_mode='r'):
+    ''' Reader of an export: returns {branch: array} for scalar branches and
+    {branch: (offsets, values)} for jagged ones, memory-mapped by default.
+    Entry i of a jagged branch is values[offsets[i]:offsets[i+1]]. '''
+    with open(os.path.join(outdir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    arrays = dict()
+    for entry in manifest['branches']:
+        load = lambda name: np.load(os.path.join(outdir, entry[name]),
+            mmap_mode=mmap_mode)
+        if entry['layout'] == 'scalar':
+            arrays[entry['name']] = load('values')
+        else:
+            arrays[entry['name']] = (load('offsets'), load('values'))
+    return arrays
+
+
+if __name__ == '__main__':
+    ## ARGPARSING ##
+    parser = argparse.ArgumentParser(
+                        prog = 'export_arrays',
+                        description = 'Export branches to memory-mappable '\
+                        +'.npy files in fixed size chunks of entries. '\
+                        +'vector<T> branches are written as offsets + values.')
+    parser.add_argument('rootfile', # positional argument
+                        help='ROOT file to export.')
+    parser.add_argument('outdir',
+                        help='Folder for the .npy files and manifest.json.')
+    parser.add_argument('--tree-name', dest='tree_name', action='store',
+                        default='tree', type=str,
+                        help='Name of the tree, i.e. tname or dir/tname.')
+    parser.add_argument('--branches', dest='branches', action='store',
+                        default=None, type=str, nargs='+',
+                        help='Branches to export. Default is every branch '\
+                        +'of a supported type.')
+    parser.add_argument('--chunk-size', dest='chunk_size', action='store',
+                        default=100000, type=int,
+                        help='Entries per chunk.')
+    args = parser.parse_intermixed_args()
+
+    print('\n'+'-'*80)
+    print('-- Exporting arrays from: {}'.format(args.rootfile))
+    print('-'*80+'\n')
+
+    TFile = open_rfile(args.rootfile)
+    if TFile is None:
+        sys.exit('\nCannot open TFile, exiting program..\n')
+    try:
+        Tree = get_tree(TFile, args.tree_name)
+    except AmbiguousTreeError as err:
+        sys.exit('{}\n'.format(err))
+    except ReferenceError as re:
+        sys.exit('Tree with name {} does not exist in file {}\n'.format(
+            args.tree_name, args.rootfile))
+    os.makedirs(args.outdir, exist_ok=True)
+
+    Branches = args.branches
+    if Branches is None:
+        Branches = [str(b.GetName()) for b in Tree.GetListOfBranches()]
+    Manifest = dict(file=args.rootfile, tree=args.tree_name,
+        entries=int(Tree.GetEntries()), branches=[])
+    for branch in Branches:
+        start = time.perf_counter()
+        try:
+            Manifest['branches'].append(export_branch(Tree, branch,
+                args.outdir, args.chunk_size))
+        except TypeError as te:
+            print('    skipping: {}'.format(te))
+            continue
+        print('    {:32s} {:8s} {:.1f} s'.format(branch,
+            Manifest['branches'][-1]['layout'], time.perf_counter() - start))
+
+    with open(os.path.join(args.outdir, 'manifest.json'), 'w') as f:
+        json.dump(Manifest, f, indent=2)
+    TFile.Close()
+    print('\nExported {} branches to {}\n'.format(len(Manifest['branches']),
+        args.outdir))
@@ -0,0 +1,152 @@
+#!/bin/bash
+#!/cvmfs/sft.cern.ch/lcg/views/LCG_101_ATLAS_26/x86_64-centos7-gcc11-opt/bin/python
+
+'''
+Script to generate reproducible test ROOT files with r21 style jet branches,
+vector<float> and vector<vector<float>> cell branches in a nested directory
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import argparse, os
+from utils import declare_cpp
+
+JET_VARIABLES = ['pt', 'eta', 'phi', 'jettiming', 'jetHECFrac',
+'jetHECQuality', 'jetEMFrac', 'jetJVT', 'jetLArQuality', 'jetNegativeE',
+'normjetAverageLArQF', 'jetNtrk', 'jetFracSamplingMax', 'jetTileScinMax']
+
+GENERATOR = """
+#include <cstring>
+#include <string>
+#include <vector>
+#include "TFile.h"
+#include "TTree.h"
+#include "TH1F.h"
+#include "TRandom3.h"
+#include "TMath.h"
+
+Long64_t rh_generate_tree(const char *fname, const char *dirpath,
+    const char *treename, Long64_t nentries, UInt_t seed, Double_t ncells,
+    Int_t nsamples, Int_t compress)
+{
+    TFile f(fname, "RECREATE");
+    if (compress >= 0)
+        f.SetCompressionSettings(compress);
+    // owned by the file, which deletes them on Close
+    TH1F *hpt = new TH1F("h_pt0", "leading jet pt", 100, 0., 500.);
+    TDirectory *dir = &f;
+    if (std::strlen(dirpath) > 0) {
+        f.mkdir(dirpath);
+        dir = f.GetDirectory(dirpath);
+    }
+    dir->cd();
+
+    TRandom3 rng(seed);
+    TTree *tree = new TTree(treename, treename);
+    const std::vector<std::string> names = {%s};
+    std::vector<Float_t> jets(2 * names.size());
+    for (size_t i = 0; i < names.size(); ++i)
+        for (size_t j = 0; j < 2; ++j) {
+            std::string name = names[i] + std::to_string(j);
+            tree->Branch(name.c_str(), &jets[2*i + j], (name + "/F").c_str());
+        }
+    Int_t RunNumber = 0;
+    ULong64_t eventNumber = 0;
+    std::vector<float> cell_e;
+    std::vector<std::vector<float>> cell_samples;
+    tree->Branch("RunNumber", &RunNumber, "RunNumber/I");
+    tree->Branch("eventNumber", &eventNumber, "eventNumber/l");
+    tree->Branch("cell_e", &cell_e);
+    tree->Branch("cell_samples", &cell_samples);
+
+    for (Long64_t entry = 0; entry < nentries; ++entry) {
+        RunNumber = 300000 + rng.Integer(8);
+        eventNumber = entry;
+        for (size_t i = 0; i < names.size(); ++i)
+            for (size_t j = 0; j < 2; ++j) {
+                Float_t value = rng.Gaus(0., 1.);
+                if (names[i] == "pt")
+                    value = 20. + rng.Exp(50.);
+                else if (names[i] == "eta")
+                    value = rng.Uniform(-4.5, 4.5);
+                else if (names[i] == "phi")
+                    value = rng.Uniform(-TMath::Pi(), TMath::Pi());
+                else if (names[i] == "jetNtrk")
+                    value = rng.Poisson(10.);
+                jets[2*i + j] = value;
+            }
+        hpt->Fill(jets[0]);
+
+        const Int_t n = rng.Poisson(ncells);
+        cell_e.resize(n);
+        cell_samples.resize(n);
+        for (Int_t c = 0; c < n; ++c) {
+            cell_e[c] = rng.Exp(1.);
+            cell_samples[c].resize(nsamples);
+            for (Int_t s = 0; s < nsamples; ++s)
+                cell_samples[c][s] = rng.Gaus(cell_e[c], 0.1);
+        }
+        tree->Fill();
+    }
+    tree->Write();
+    f.cd();
+    hpt->Write();
+    f.Close();
+    return nentries;
+}
+""" % ', '.join('"{}"'.format(name) for name in JET_VARIABLES)
+
+
+## ARGPARSING ##
+parser = argparse.ArgumentParser(
+                    prog = 'generate_testfile',
+                    description = 'Generate reproducible test ROOT files '\
+                    +'with r21 jet branches (name0/name1), RunNumber, '\
+                    +'eventNumber, vector<float> and vector<vector<float>> '\
+                    +'cell branches.')
+parser.add_argument('output', # positional argument
+                    help='Name of the ROOT file to write. With --nfiles an '\
+                    +'index is appended.')
+parser.add_argument('--entries', dest='entries', action='store',
+                    default=10000, type=int,
+                    help='Number of entries per file.')
+parser.add_argument('--nfiles', dest='nfiles', action='store',
+                    default=1, type=int,
+                    help='Number of files to write, each with its own seed.')
+parser.add_argument('--seed', dest='seed', action='store',
+                    default=42, type=int,
+                    help='Random seed of the first file.')
+parser.add_argument('--tree-name', dest='tree_name', action='store',
+                    default='nominal/tree', type=str,
+                    help='Tree path, directories are created as nested '\
+                    +'TDirectoryFiles. Default is nominal/tree.')
+parser.add_argument('--cells', dest='cells', action='store',
+                    default=20., type=float,
+                    help='Average number of cells per entry.')
+parser.add_argument('--samples', dest='samples', action='store',
+                    default=4, type=int,
+                    help='Number of samples per cell in cell_samples.')
+parser.add_argument('--compression', dest='compression', action='store',
+                    default=-1, type=int,
+                    help='Compression settings (100*algorithm+level). '\
+                    +'Default is ROOT\'s.')
+args = parser.parse_intermixed_args()
+
+import ROOT
+
+DirPath, _, TreeName = args.tree_name.rpartition('/')
+
+cl = ROOT.TClass.GetClass('vector<vector<float> >')
+if not cl or not cl.HasDictionary():
+    ROOT.gInterpreter.GenerateDictionary('vector<vector<float> >', 'vector')
+generate = declare_cpp('rh_generate_tree', GENERATOR)
+
+Outputs = [args.output] if args.nfiles == 1 else \
+    [args.output.replace('.root', '') + '_{}.root'.format(i)
+    for i in range(args.nfiles)]
+
+for i, output in enumerate(Outputs):
+    generate(output, DirPath, TreeName, args.entries, args.seed + i,
+        args.cells, args.samples, args.compression)
+    print('Wrote {} entries of {} to {} ({:.1f} MB)'.format(args.entries,
+        args.tree_name, output, os.path.getsize(output) / 1e6))
@@ -0,0 +1,111 @@
+'''
+Manifest of the outputs written by the tools: input fingerprints, tool
+options and output checksum per output file, so reruns skip the outputs that
+are up to date. Outputs are written to a temporary path and only renamed into
+place once complete, a killed job never leaves a truncated file behind.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import os, json, hashlib
+from contextlib import contextmanager
+from metacache import file_stat
+
+DEFAULT_NAME = '.root_helpers_manifest.json'
+
+
+## FUNCTIONS ##
+def file_checksum(path, blocksize=1<<22):
+    ''' blake2b digest of the file content. '''
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def options_digest(options):
+    ''' Digest of a JSON serialisable dictionary of tool options. '''
+    return hashlib.sha1(json.dumps(options, sort_keys=True,
+        default=str).encode()).hexdigest()
+
+def temp_name(path):
+    ''' Temporary name of path in the same folder, keeping the extension
+    so ROOT still recognises the file. '''
+    root, ext = os.path.splitext(path)
+    return '{}.tmp{}{}'.format(root, os.getpid(), ext)
+
+@contextmanager
+def atomic_outputs(*paths):
+    ''' Yields temporary names of paths, renamed to paths when the block
+    finishes and removed when it raises. '''
+    temps = [temp_name(path) for path in paths]
+    try:
+        yield temps
+        for temp, path in zip(temps, paths):
+            os.replace(temp, path)
+    except BaseException:
+        for temp in temps:
+            if os.path.exists(temp):
+                os.remove(temp)
+        raise
+
+
+class Manifest:
+    ''' JSON file with one entry per output, keyed on its real path. An
+    output is current when the size and modification time of its inputs,
+    the tool options and its own size and modification time all match the
+    entry. Inputs not on a local filesystem are never current. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = self._load()
+        self._changed = dict()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def is_current(self, output, inputs, options):
+        entry = self.entries.get(os.path.realpath(output))
+        if entry is None:
+            return False
+        fingerprints = [file_stat(i) for i in inputs]
+        if None in fingerprints:
+            return False
+        stat = file_stat(output)
+        return stat is not None and \
+            entry['inputs'] == [list(f) for f in fingerprints] and \
+            entry['options'] == options_digest(options) and \
+            entry['output'] == list(stat)
+
+    def record(self, output, inputs, options, checksum=None):
+        ''' Adds the entry of a finished output, the checksum is computed
+        if not given. '''
+        entry = dict(
+            inputs = [list(file_stat(i) or (i, None, None)) for i in inputs],
+            options = options_digest(options),
+            output = list(file_stat(output)),
+            checksum = checksum or file_checksum(output))
+        self.entries[entry['output'][0]] = entry
+        self._changed[entry['output'][0]] = entry
+        return entry
+
+    def save(self):
+        ''' Merges the recorded entries into the file on disk, so tools
+        sharing a manifest do not drop each other's entries. '''
+        if not self._changed:
+            return None
+        entries = self._load()
+        entries.update(self._changed)
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        temp = temp_name(self.path)
+        with open(temp, 'w') as f:
+            json.dump(entries, f, indent=1)
+        os.replace(temp, self.path)
+        self.entries = entries
+        self._changed = dict()
+        return None
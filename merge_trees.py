@@ -0,0 +1,194 @@
+#!/bin/bash
+#!/cvmfs/sft.cern.ch/lcg/views/LCG_101_ATLAS_26/x86_64-centos7-gcc11-opt/bin/python
+
+'''
+Script to combine the trees of many files into one or several outputs, the
+counterpart of split_trees. Inputs with the same branches and compression are
+merged by copying their compressed baskets; otherwise contiguous chunks are
+recompressed in parallel processes and the partial files merged afterwards.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import argparse, sys, os, json, time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from utils import expand_paths, merge_signature, merge_groups, merge_files, \
+    schema_summary, decode_compression
+
+
+## FUNCTIONS ##
+def output_name(output, index, ngroups):
+    if ngroups == 1:
+        return output
+    return output.replace('.root', '') + '_{}.root'.format(index)
+
+def chunks(items, n):
+    ''' Splits items, in order, into at most n contiguous chunks. '''
+    size = -(-len(items) // max(1, n))
+    return [items[i:i+size] for i in range(0, len(items), size)]
+
+
+if __name__ == '__main__':
+    ## ARGPARSING ##
+    parser = argparse.ArgumentParser(
+                        prog = 'merge_trees',
+                        description = 'Concatenate the trees (and merge the '\
+                        +'other objects) of many ROOT files into one or several '\
+                        +'outputs. Baskets are copied when branches and '\
+                        +'compression match, other inputs are recompressed in '\
+                        +'parallel.')
+    parser.add_argument('rootfile', # positional argument
+                        nargs='+',
+                        help='ROOT files to merge. Accepts glob patterns, '\
+                        +'directories and @filelist text files.')
+    parser.add_argument('-o', '--output', dest='output', action='store',
+                        required=True, type=str,
+                        help='Merged file. With --max-size an index is '\
+                        +'appended for each output.')
+    parser.add_argument('--tree-name', dest='tree_name', action='store',
+                        default='tree', type=str,
+                        help='Tree whose branches must agree between inputs, '\
+                        +'i.e. tname or dir/tname.')
+    parser.add_argument('--max-size', dest='max_size', action='store',
+                        default=None, type=float,
+                        help='Maximum size of each output in MB, estimated '\
+                        +'from the input sizes.')
+    parser.add_argument('--compression', dest='compression', action='store',
+                        default=None, type=int,
+                        help='Compression settings of the outputs '\
+                        +'(100*algorithm+level). Default is the most common one '\
+                        +'of the inputs.')
+    parser.add_argument('--jobs', dest='jobs', action='store',
+                        default=os.cpu_count(), type=int,
+                        help='Number of worker processes.')
+    parser.add_argument('--json-out', dest='json_out', action='store',
+                        default=None, type=str,
+                        help='Write the results to this JSON file.')
+    args = parser.parse_intermixed_args()
+
+    RootFiles = expand_paths(args.rootfile)
+    if len(RootFiles) == 0:
+        sys.exit('\nNo ROOT files matched {}, exiting program..\n'.format(
+            args.rootfile))
+    Jobs = max(1, args.jobs)
+    MaxBytes = None if args.max_size is None else int(args.max_size * 1e6)
+
+
+    ## MAIN ##
+    print('\n'+'-'*80)
+    print('-- Merging {} files into: {}'.format(len(RootFiles), args.output))
+    print('-'*80+'\n')
+    Start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=Jobs) as pool:
+        Signatures = list(pool.map(merge_signature, RootFiles,
+            [args.tree_name]*len(RootFiles)))
+    Failed = [s for s in Signatures if not s['ok']]
+    if Failed:
+        for signature in Failed:
+            print('    {}\n        {}'.format(signature['file'],
+                signature['error']))
+        sys.exit('\nCannot read {} inputs, exiting program..\n'.format(
+            len(Failed)))
+
+    Summary = schema_summary(Signatures)
+    if Summary['schema_mismatches']:
+        print('Branches of {} differ between inputs:'.format(args.tree_name))
+        for mismatch in Summary['schema_mismatches']:
+            print('    {}\n        missing {}, extra {}, retyped {}'.format(
+                mismatch['file'], mismatch['missing'], mismatch['extra'],
+                mismatch['retyped']))
+        sys.exit('\nOnly trees with the same branches can be merged, exiting '\
+            +'program..\n')
+
+    Compression = args.compression
+    if Compression is None:
+        Compression = Counter(s['compression']
+            for s in Signatures).most_common(1)[0][0]
+    print('Output compression: {algorithm} level {level}'.format(
+        **decode_compression(Compression)))
+
+    # Each output is a group of inputs. Groups which all share the output
+    # compression are merged in one fast pass, the others are split into
+    # contiguous chunks merged in parallel and the partial files fast merged.
+    Groups = merge_groups(Signatures, MaxBytes)
+    Direct, Partials = [], dict()
+    for index, group in enumerate(Groups):
+        output = output_name(args.output, index, len(Groups))
+        if all(s['compression'] == Compression for s in group):
+            Direct.append((output, group))
+            continue
+        Partials[output] = []
+        for j, chunk in enumerate(chunks(group, Jobs)):
+            Partials[output].append((output.replace('.root', '') + \
+                '.part{}.root'.format(j), chunk))
+
+    Results = []
+    with ProcessPoolExecutor(max_workers=Jobs) as pool:
+        futures = dict()
+        for output, group in Direct:
+            futures[pool.submit(merge_files, [s['file'] for s in group], output,
+                True, Compression)] = output
+        for output, parts in Partials.items():
+            for partname, chunk in parts:
+                fast = all(s['compression'] == Compression for s in chunk)
+                futures[pool.submit(merge_files, [s['file'] for s in chunk],
+                    partname, fast, Compression)] = partname
+        PartResults = dict()
+        for future in as_completed(futures):
+            result = future.result()
+            print('    [{}] {}'.format('done' if result['ok'] else 'FAIL',
+                result['output']))
+            if any(futures[future] == output for output, group in Direct):
+                Results.append(result)
+            else:
+                PartResults[futures[future]] = result
+
+        # the partial files share the output compression, baskets are copied
+        futures = dict()
+        for output, parts in Partials.items():
+            if all(PartResults[name]['ok'] for name, chunk in parts):
+                futures[pool.submit(merge_files, [name for name, chunk in parts],
+                    output, True, Compression)] = output
+            else:
+                Results.append(dict(output=output, inputs=len(parts), ok=False,
+                    error='a partial merge failed'))
+        for future in as_completed(futures):
+            Results.append(future.result())
+            print('    [{}] {}'.format('done' if Results[-1]['ok'] else 'FAIL',
+                Results[-1]['output']))
+    for parts in Partials.values():
+        for name, chunk in parts:
+            if os.path.exists(name):
+                os.remove(name)
+
+    Entries = {output_name(args.output, i, len(Groups)): sum(s['entries']
+        for s in group) for i, group in enumerate(Groups)}
+    for result in Results:
+        result['entries'] = Entries[result['output']]
+        result['recompressed'] = result['output'] in Partials
+    Wall = time.perf_counter() - Start
+
+    print('\n'+'-'*80)
+    print('-- Results')
+    print('-'*80)
+    for result in sorted(Results, key=lambda r: r['output']):
+        if result['ok']:
+            print('{}\n    {} entries, {:.1f} MB{}'.format(result['output'],
+                result['entries'], result['size'] / 1e6,
+                ', recompressed' if result['recompressed'] else ''))
+    Failed = [r for r in Results if not r['ok']]
+    print('\n -- failures: {}'.format(len(Failed)))
+    for result in Failed:
+        print('    {}\n        {}'.format(result['output'], result['error']))
+    print('\nMerged {} entries in {:.1f} s\n'.format(
+        Summary['total_entries'], Wall))
+
+    if args.json_out is not None:
+        with open(args.json_out, 'w') as f:
+            json.dump(dict(tree=args.tree_name, compression=Compression,
+                inputs=len(RootFiles), wall_time=Wall, results=Results), f,
+                indent=2)
+        print('Saved results to {}\n'.format(args.json_out))
+    sys.exit(1 if Failed else 0)
@@ -0,0 +1,152 @@
+'''
+On-disk cache of ROOT file metadata (key layout, trees, branches, entries)
+so repeated queries on the same files do not need to open them.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import os, json, hashlib
+from pathlib import Path
+
+DEFAULT_CACHE_DIR = os.environ.get('ROOT_HELPERS_CACHE',
+    str(Path.home() / '.cache' / 'root_helpers' / 'metadata'))
+DEFAULT_MAX_MB = 64
+# puts after which the cache folder is rescanned even if the estimate fits,
+# other processes sharing the folder are not seen in between
+RESCAN_EVERY = 256
+
+# estimated bytes in each cache folder and puts since its last scan, shared
+# by the caches of a process (batch workers create one per file)
+_ESTIMATES = dict()
+
+
+## FUNCTIONS ##
+def file_stat(rfilename):
+    ''' Returns the (path, size, mtime) triplet a cache record is keyed on
+    or None if the file is not on a local filesystem. '''
+    try:
+        st = os.stat(rfilename)
+    except OSError:
+        return None
+    return os.path.realpath(rfilename), st.st_size, st.st_mtime_ns
+
+
+class MetadataCache:
+    ''' One JSON record per ROOT file, stored under cache_dir. Records are
+    invalidated when the size, modification time or the TFile UUID changes,
+    and the least recently used records are evicted once the cache grows
+    beyond max_mb. '''
+
+    def __init__(self, cache_dir=None, max_mb=DEFAULT_MAX_MB):
+        self.cache_dir = Path(cache_dir or DEFAULT_CACHE_DIR)
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    def _record_path(self, realpath):
+        digest = hashlib.sha1(realpath.encode()).hexdigest()
+        return self.cache_dir / '{}.json'.format(digest)
+
+    def get(self, rfilename):
+        ''' Returns the cached record for rfilename or None if missing or
+        stale. '''
+        stat = file_stat(rfilename)
+        if stat is None:
+            return None
+        realpath, size, mtime = stat
+        recpath = self._record_path(realpath)
+        try:
+            with open(recpath) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if record.get('path') != realpath or record.get('size') != size \
+            or record.get('mtime') != mtime:
+            self.invalidate(rfilename)
+            return None
+        # mark as recently used for the eviction
+        os.utime(recpath)
+        return record
+
+    def put(self, rfilename, uuid=None, **fields):
+        ''' Merges fields into the record of rfilename. A UUID that differs
+        from the stored one drops everything cached so far. '''
+        stat = file_stat(rfilename)
+        if stat is None:
+            return None
+        realpath, size, mtime = stat
+        record = self.get(rfilename)
+        if record is None or (uuid is not None and record.get('uuid') \
+            not in (None, uuid)):
+            record = dict(path=realpath, size=size, mtime=mtime)
+        if uuid is not None:
+            record['uuid'] = uuid
+        for name, value in fields.items():
+            if isinstance(value, dict) and isinstance(record.get(name), dict):
+                record[name].update(value)
+            else:
+                record[name] = value
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        recpath = self._record_path(realpath)
+        tmppath = recpath.with_suffix('.tmp{}'.format(os.getpid()))
+        with open(tmppath, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmppath, recpath)
+        self._account(recpath)
+        return record
+
+    def _account(self, recpath):
+        ''' Adds a written record to the size estimate of the folder and
+        evicts only once the estimate exceeds the limit. '''
+        folder = str(self.cache_dir)
+        if folder not in _ESTIMATES:
+            self.evict()
+            return None
+        estimate = _ESTIMATES[folder]
+        try:
+            estimate[0] += recpath.stat().st_size
+        except OSError:
+            pass
+        estimate[1] += 1
+        if estimate[0] > self.max_bytes or estimate[1] >= RESCAN_EVERY:
+            self.evict()
+        return None
+
+    def invalidate(self, rfilename):
+        stat = file_stat(rfilename)
+        if stat is None:
+            return None
+        try:
+            os.remove(self._record_path(stat[0]))
+        except OSError:
+            pass
+        return None
+
+    def clear(self):
+        for recpath in self.cache_dir.glob('*.json'):
+            recpath.unlink()
+        _ESTIMATES[str(self.cache_dir)] = [0, 0]
+        return None
+
+    def evict(self):
+        ''' Removes least recently used records until the cache fits. '''
+        records = []
+        for recpath in self.cache_dir.glob('*.json'):
+            try:
+                st = recpath.stat()
+            except OSError:
+                continue
+            records.append((st.st_mtime_ns, st.st_size, recpath))
+        total = sum(r[1] for r in records)
+        # evict below the limit, so a full cache is not rescanned every put
+        target = self.max_bytes if total <= self.max_bytes \
+            else int(0.9 * self.max_bytes)
+        for mtime, size, recpath in sorted(records):
+            if total <= target:
+                break
+            try:
+                recpath.unlink()
+            except OSError:
+                pass
+            total -= size
+        _ESTIMATES[str(self.cache_dir)] = [total, 0]
+        return None
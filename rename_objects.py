@@ -9,9 +9,16 @@ author: Russell Bate
 email: russell.bate@cern.ch, russellbate@phas.ubc.ca
 '''
 
-import argparse, sys, os
-import ROOT
+import argparse, sys, os, glob
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from utils import open_rfile, expand_paths, parse_mapping, \
+	renamed_filename, resolve_tree, rename_tree, rename_file, set_tree_cache, \
+	print_read_stats, AmbiguousTreeError
+from cli import add_snapshot_args, write_options_from_args, add_report_args, \
+	RunReport, add_manifest_args, open_manifest, tool_options, \
+	add_tree_cache_args, set_read_cache_env
+from manifest import atomic_outputs
 
 r21_extras = ['jetTileScinMax', 'pt',  'RunNumber',   
 'eventNumber',  'phi', 'eta']
@@ -34,248 +41,369 @@ same_branches = ['pt', 'phi', 'eta']
 event_branches = ['RunNumber', 'eventNumber']
 
 
-## FUNCTIONS ##
-def open_rfile(rfilename):
-	''' Handles error if opening fails (In python OSError) 
-	returns None if ROOT cannot open the file. '''
-	try:
-		f = ROOT.TFile.Open(rfilename)
-		return f
-	except OSError as ose:
-		print('Caught OSError: \n{} \n'.format(ose))
-		return None
-
-## ARGPARSING ##
-parser = argparse.ArgumentParser(
-					prog = 'rename_objects', #epilog = ''
-					description = 'Create new snapshot with .') 
-parser.add_argument('rootfile', # positional argument
-					help='ROOT file to change.')
-parser.add_argument('--verbose', action='store_true',
-					help='ROOT file to change.')
-parser.add_argument('--r21-to-r22', dest='r21tor22', action='store_true',
-					help='Default naming convention for Athena release 21 '\
-					+'jets to release 22.')
-parser.add_argument('--leading', dest='leading', action='store_true',
-					help='Use flag if naming convention uses trailing 0 to '\
-					+'indicate the leading jet.')
-parser.add_argument('--subleading', dest='subleading', action='store_true',
-					help='Use flag if naming convention uses trailing 1 to '\
-					+'indicate the sub-leading jet.')
-parser.add_argument('--savefolder', dest='savefolder', action='store',
-					default=None, type=str,
-					help='Folder to save the renamed trees. Default is in '\
-					+'the same folder.')
-tree_group = parser.add_argument_group('tree_group')
-tree_group.add_argument('--tree-name', dest='tree_name', action='store',
-					default='tree', type=str,
-					help='Name of which tree to inspect.')
-tree_group.add_argument('--old-branches', dest='old_branches', action='store',
-					type=str, nargs='+',
-					help='Names of branches to change to.')
-tree_group.add_argument('--new-branches', dest='new_branches', action='store',
-					type=str, nargs='+',
-					help='Names of branches to change to.')
-args = parser.parse_intermixed_args()
-
-SaveFolder = args.savefolder
-TreeName = args.tree_name
-Verbose = args.verbose
-RootFile = args.rootfile
-R21toR22 = args.r21tor22
-Leading = args.leading
-SubLeading = args.subleading
-OldBranches = args.old_branches
-NewBranches = args.new_branches
-
-ParentDir = Path(rfilename).parent
-RootFile_lone = Path(rfilename).name
-
-if SaveFolder is None:
-	
-	SaveFolder = str(ParentDir)
-
-	if not os.path.exists('{}'.format(SaveFolder)):
-		print('Folder:')
-		print('{}'.format(SaveFolder))
-		print('does not exist ==> creating folder!\n')
-		os.system('mkdir -p {}'.format(SaveFolder))
-else:
-	if not os.path.exists('{}'.format(SaveFolder)):
-		raise ValueError('{} does not exist.'.format(SaveFolder))
-	if SaveFolder[-1] != '/':
-		SaveFolder += '/'
-	print('Saving file(s) to {}'.format(SaveFolder))
-
-							##############
-							## BRANCHES ##
-							##############
-#=============================================================================#
-if R21toR22:
-	OldBranches = r21_branches
-	NewBranches = r22_branches
-
-if Leading and not SubLeading:
-	r21_leading_branches = []
-	r22_leading_branches = []
-	new_same_branches = []
-
-	for i, branch in enumerate(OldBranches):
-		r21_leading_branches.append(branch + '0')
-	OldBranches = r21_leading_branches
-
-	for i, branch in enumerate(NewBranches):
-		r22_leading_branches.append(branch + '0')
-	NewBranches = r22_leading_branches
-
-	for i, branch in enumerate(same_branches):
-		new_same_branches.append(branch + '0')
-	same_branches = new_same_branches
-
-elif SubLeading and not Leading:
-	r21_subleading_branches = []
-	r22_subleading_branches = []
-	new_same_branches = []
-
-	for i, branch in enumerate(OldBranches):
-		r21_subleading_branches.append(branch + '1')
-	OldBranches = r21_subleading_branches
-
-	for i, branch in enumerate(NewBranches):
-		r22_subleading_branches.append(branch + '1')
-	NewBranches = r22_subleading_branches
-
-	for i, branch in enumerate(same_branches):
-		new_same_branches.append(branch + '1')
-	same_branches = new_same_branches
-
-elif Leading and SubLeading:
-	r21_leading_branches = []
-	r21_subleading_branches = []
-	r22_leading_branches = []
-	r22_subleading_branches = []
-	new_subleading_branches = []
-	new_leading_branches = []
-
-	for i, branch in enumerate(OldBranches):
-		r21_leading_branches.append(branch + '0')
-		r21_subleading_branches.append(branch + '1')
-	OldBranches = r21_leading_branches + r21_subleading_branches
-
-	for i, branch in enumerate(NewBranches):
-		r22_leading_branches.append(branch + '0')
-		r22_subleading_branches.append(branch + '1')
-	NewBranches = r22_leading_branches + r22_subleading_branches
-
-	for i, branch in enumerate(same_branches):
-		new_leading_branches.append(branch + '0')
-		new_subleading_branches.append(branch + '1')
-
-	same_branches = new_leading_branches + new_subleading_branches
-
-if R21toR22:
-	inclusive_branches = same_branches + OldBranches + event_branches
-else:
-	inclusive_branches = OldBranches
-#=============================================================================#
-
-
-## MAIN ##
-print('\n'+'-'*80)
-print('-- Changing Branches For: {}'.format(RootFile))
-print('-'*80+'\n')
-
-TFile = open_rfile(RootFile)
-if TFile is None:
-	sys.exit('\nCannot open TFile, exiting program..\n')
-RootFileName = Path(RootFile).name
-RootFileParent = Path(RootFile).parent
-
-
-## Catch for treename
-if len(TreeName.split('/')) > 2:
-	raise ValueError('Nesting of trees beyond depth of 2 not supported'\
-		+' (yet): {}.'.format(Treename))
-
-## Open Tree ##
-try:
-	if '/' in TreeName:
-		TDirectory = TFile.GetKey(TreeName.split('/')[0]).ReadObj()
-		Tree = TDirectory.GetKey(TreeName.split('/')[1]).ReadObj()
-	else:
-		Tree = TFile.GetKey("{}".format(TreeName)).ReadObj()
-	file_branchnames = []
-	Branches = Tree.GetListOfBranches()
-
-	if Verbose:
-		print('Number of branches in file: {}\n'.format(len(Branches)))
-		for branch in Branches:
-			file_branchnames.append(str(branch.GetFullName()))
-			print('    {}'.format(file_branchnames[-1]))
+if __name__ == '__main__':
+	## ARGPARSING ##
+	parser = argparse.ArgumentParser(
+						prog = 'rename_objects', #epilog = ''
+						description = 'Create new snapshot with .') 
+	parser.add_argument('rootfile', # positional argument
+						nargs='+',
+						help='ROOT file(s) to change. Accepts glob patterns, '\
+						+'directories and @filelist text files. More than one '\
+						+'argument, or any pattern, directory or file list, '\
+						+'runs the non-interactive batch mode.')
+	parser.add_argument('--verbose', action='store_true',
+						help='ROOT file to change.')
+	parser.add_argument('--r21-to-r22', dest='r21tor22', action='store_true',
+						help='Default naming convention for Athena release 21 '\
+						+'jets to release 22.')
+	parser.add_argument('--leading', dest='leading', action='store_true',
+						help='Use flag if naming convention uses trailing 0 to '\
+						+'indicate the leading jet.')
+	parser.add_argument('--subleading', dest='subleading', action='store_true',
+						help='Use flag if naming convention uses trailing 1 to '\
+						+'indicate the sub-leading jet.')
+	parser.add_argument('--savefolder', dest='savefolder', action='store',
+						default=None, type=str,
+						help='Folder to save the renamed trees. Default is in '\
+						+'the same folder.')
+	tree_group = parser.add_argument_group('tree_group')
+	tree_group.add_argument('--tree-name', dest='tree_name', action='store',
+						default='tree', type=str,
+						help='Name of which tree to inspect.')
+	tree_group.add_argument('--old-branches', dest='old_branches', action='store',
+						type=str, nargs='+',
+						help='Names of branches to change to.')
+	tree_group.add_argument('--new-branches', dest='new_branches', action='store',
+						type=str, nargs='+',
+						help='Names of branches to change to.')
+	parser.add_argument('--fast-clone', dest='fast_clone', default=True,
+						action=argparse.BooleanOptionalAction,
+						help='Copy the compressed baskets and only rename the '\
+						+'branches. Falls back to RDataFrame when not possible.')
+	parser.add_argument('--output-mode', dest='output_mode', action='store',
+						default='full', type=str, choices=['full', 'friend'],
+						help='full writes the renamed and copied branches to '\
+						+'NAME_NewBranches.root. friend only writes the renamed '\
+						+'branches to NAME_Friend.root, a friend tree of the '\
+						+'unchanged original (see utils.open_with_friend).')
+	parser.add_argument('--cast', dest='cast', action='store',
+						type=str, nargs='+', default=[],
+						help='Type changes of renamed branches as NEWNAME=TYPE. '\
+						+'Requires the RDataFrame path.')
+	parser.add_argument('--mapping', dest='mapping', action='store',
+						default=None, type=str,
+						help='Branch mapping file, one "old new [jet_indices] '\
+						+'[type]" rule per line. Replaces the branch options, '\
+						+'see mappings/r21_to_r22.txt.')
+	parser.add_argument('--yes', dest='yes', action='store_true',
+						help='Do not ask for confirmation.')
+	parser.add_argument('--jobs', dest='jobs', action='store',
+						default=os.cpu_count(), type=int,
+						help='Number of worker processes in batch mode.')
+	add_snapshot_args(parser)
+	add_tree_cache_args(parser)
+	add_report_args(parser)
+	add_manifest_args(parser)
+	args = parser.parse_intermixed_args()
+	if any('=' not in cast for cast in args.cast):
+		parser.error('--cast expects NEWNAME=TYPE, got {}'.format(
+			' '.join(cast for cast in args.cast if '=' not in cast)))
+
+	# process wide cache settings, inherited by the batch workers
+	set_read_cache_env(args)
+
+	SaveFolder = args.savefolder
+	TreeName = args.tree_name
+	Verbose = args.verbose
+	RootFiles = expand_paths(args.rootfile)
+	# decided on the arguments, a pattern matching one file must not prompt
+	Batch = len(args.rootfile) > 1 or any(arg.startswith('@') or
+		os.path.isdir(arg) or glob.has_magic(arg) for arg in args.rootfile)
+	Mapping = args.mapping
+	R21toR22 = args.r21tor22
+	Leading = args.leading
+	SubLeading = args.subleading
+	OldBranches = args.old_branches
+	NewBranches = args.new_branches
+	FastClone = args.fast_clone
+	WriteOptions = write_options_from_args(args)
+	Report = RunReport('rename_objects', inputs=len(RootFiles))
+
+	if len(RootFiles) == 0:
+		sys.exit('\nNo ROOT files matched {}, exiting program..\n'.format(
+			args.rootfile))
+
+	if SaveFolder is not None:
+		if not os.path.exists('{}'.format(SaveFolder)):
+			raise ValueError('{} does not exist.'.format(SaveFolder))
+		if SaveFolder[-1] != '/':
+			SaveFolder += '/'
+		print('Saving file(s) to {}'.format(SaveFolder))
+
+								##############
+								## BRANCHES ##
+								##############
+	#=============================================================================#
+	if R21toR22:
+		OldBranches = r21_branches
+		NewBranches = r22_branches
+
+	if Leading and not SubLeading:
+		r21_leading_branches = []
+		r22_leading_branches = []
+		new_same_branches = []
+
+		for i, branch in enumerate(OldBranches):
+			r21_leading_branches.append(branch + '0')
+		OldBranches = r21_leading_branches
+
+		for i, branch in enumerate(NewBranches):
+			r22_leading_branches.append(branch + '0')
+		NewBranches = r22_leading_branches
+
+		for i, branch in enumerate(same_branches):
+			new_same_branches.append(branch + '0')
+		same_branches = new_same_branches
+
+	elif SubLeading and not Leading:
+		r21_subleading_branches = []
+		r22_subleading_branches = []
+		new_same_branches = []
+
+		for i, branch in enumerate(OldBranches):
+			r21_subleading_branches.append(branch + '1')
+		OldBranches = r21_subleading_branches
+
+		for i, branch in enumerate(NewBranches):
+			r22_subleading_branches.append(branch + '1')
+		NewBranches = r22_subleading_branches
+
+		for i, branch in enumerate(same_branches):
+			new_same_branches.append(branch + '1')
+		same_branches = new_same_branches
+
+	elif Leading and SubLeading:
+		r21_leading_branches = []
+		r21_subleading_branches = []
+		r22_leading_branches = []
+		r22_subleading_branches = []
+		new_subleading_branches = []
+		new_leading_branches = []
+
+		for i, branch in enumerate(OldBranches):
+			r21_leading_branches.append(branch + '0')
+			r21_subleading_branches.append(branch + '1')
+		OldBranches = r21_leading_branches + r21_subleading_branches
+
+		for i, branch in enumerate(NewBranches):
+			r22_leading_branches.append(branch + '0')
+			r22_subleading_branches.append(branch + '1')
+		NewBranches = r22_leading_branches + r22_subleading_branches
+
+		for i, branch in enumerate(same_branches):
+			new_leading_branches.append(branch + '0')
+			new_subleading_branches.append(branch + '1')
+
+		same_branches = new_leading_branches + new_subleading_branches
+
+	if R21toR22:
+		inclusive_branches = same_branches + OldBranches + event_branches
 	else:
-		for branch in Branches:
-			file_branchnames.append(str(branch.GetFullName()))
-
-except ReferenceError as re:
-	print('TFile.GetKey({})'.format(TreeName))
-	print('Returned a null pointer. Tree with name {}'.format(TreeName))
-	print('does not exist in file {}\n'.format(RootFileName))
-	sys.exit()
-
-
-							###################
-							## COPY BRANCHES ##
-							###################
-#=============================================================================#
-leftover_branches = []
-for filebranch in file_branchnames:
-	FoundBranch = False
-	for branch in inclusive_branches:
-		if branch == filebranch:
-			FoundBranch = True
-			break
-	if FoundBranch == False:
-		leftover_branches.append(filebranch)
-#=============================================================================#
-
-print('\n'+'-'*54)
-print('-- Creating Copy Trees with the following variables --')
-print('-'*54)
-print(' .. loading dataframe ..')
-df = ROOT.RDataFrame(Tree)
-branches_not_in = []
-save_cols = []
-
-print('\n -- changes')
-for oldbranch, newbranch in zip(OldBranches, NewBranches):
-	if not oldbranch in file_branchnames:
-		branches_not_in.append(oldbranch)
-		continue
-	print('	{:25s} ==> {}'.format(oldbranch, newbranch))
-	save_cols.append(newbranch)
-	df = df.Define(newbranch, oldbranch)
-
-print('\n -- copying branches')
-for branch in same_branches:
-	save_cols.append(branch)
-	print('	{}'.format(branch))
-
-print('\n -- left over branches not copied')
-for branch in leftover_branches:
-	print('	{}'.format(branch))
-
-print('\n -- branches not in original tree')
-for branch in branches_not_in:
-	print('	{}'.format(branch))
-
-NewRootFileName = RootFile.replace('.root', '')
-NewRootFileName += '_NewBranches.root'
-print('\nSaving new tree to: {}'.format(NewRootFileName))
-
-usr_input = input('\nWould you like to continue? (y/n)\n')
-if usr_input != 'y':
-	sys.exit('\nExiting early.\n')
-
-df.Snapshot(TreeName, NewRootFileName, save_cols)
-print('\nFinished saving copy.\n')
-
+		inclusive_branches = OldBranches
+
+	Casts = dict(cast.split('=', 1) for cast in args.cast)
+	if Mapping is not None:
+		renames, same_branches, map_casts = parse_mapping(Mapping)
+		Casts.update(map_casts)
+		OldBranches = list(renames.keys())
+		NewBranches = list(renames.values())
+		inclusive_branches = same_branches + OldBranches
+	if OldBranches is None or NewBranches is None:
+		sys.exit('\nNo branches to rename, give --mapping, --r21-to-r22 or '\
+			+'--old-branches and --new-branches.\n')
+
+	# a friend tree only holds the renamed branches, the rest stays in the input
+	FriendMode = args.output_mode == 'friend'
+	Suffix = '_Friend' if FriendMode else '_NewBranches'
+	if FriendMode:
+		same_branches = []
+	#=============================================================================#
+
+	# outputs are skipped when the manifest shows the same input and options
+	AllRenames = dict(zip(OldBranches, NewBranches))
+	Manifest = open_manifest(args, SaveFolder or
+		os.path.dirname(renamed_filename(RootFiles[0], None, Suffix)))
+	Options = dict(tool_options(args), renames=AllRenames, keep=same_branches,
+		casts=Casts)
+	Current = [rfile for rfile in RootFiles if not args.force and
+		Manifest.is_current(renamed_filename(rfile, SaveFolder, Suffix), [rfile], Options)]
+
+
+	## BATCH ##
+	if Batch:
+		Todo = [rfile for rfile in RootFiles if rfile not in Current]
+		print('\n -- renaming {} branches in {} files with {} workers'.format(
+			len(AllRenames), len(Todo), args.jobs))
+		if Current:
+			print(' -- skipping {} up to date files (use --force to rewrite)'\
+				.format(len(Current)))
+		Results = []
+		with Report.stage('batch'), \
+			ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+			futures = [pool.submit(rename_file, rfile,
+				renamed_filename(rfile, SaveFolder, Suffix), TreeName, AllRenames,
+				same_branches, Casts, FastClone, WriteOptions, True,
+				args.tree_cache_size, args.tree_cache_used_only)
+				for rfile in Todo]
+			for future in as_completed(futures):
+				Results.append(future.result())
+				result = Results[-1]
+				print('	[{}] {}'.format('done' if result['ok'] else 'FAIL',
+					result['file']))
+				if result['ok']:
+					Manifest.record(result['output'], [result['file']], Options,
+						result['checksum'])
+		Manifest.save()
+
+		print('\n'+'-'*80)
+		print('-- Results')
+		print('-'*80)
+		Failed = [r for r in Results if not r['ok']]
+		for result in sorted(Results, key=lambda r: r['file']):
+			if result['ok']:
+				print('{}\n	==> {} ({}, {} renamed, {} missing)'.format(
+					result['file'], result['output'], result['mode'],
+					result['renamed'], len(result['missing'])))
+		print('\n -- failures: {}'.format(len(Failed)))
+		for result in Failed:
+			print('	{}\n		{}'.format(result['file'], result['error']))
+		print()
+		if args.report is not None:
+			# per file wall times point out the slow files
+			Report.update(entries=sum(r.get('entries', 0) for r in Results),
+				results=sorted(Results, key=lambda r: -r['wall_time']))
+			Report.save(args.report)
+		sys.exit(1 if Failed else 0)
+
+	RootFile = RootFiles[0]
+	if Current:
+		print('\n{} is up to date, use --force to rewrite it.\n'.format(
+			renamed_filename(RootFile, SaveFolder, Suffix)))
+		sys.exit(0)
+
+
+	## MAIN ##
+	print('\n'+'-'*80)
+	print('-- Changing Branches For: {}'.format(RootFile))
+	print('-'*80+'\n')
+
+	with Report.stage('open'):
+		TFile = open_rfile(RootFile)
+	if TFile is None:
+		sys.exit('\nCannot open TFile, exiting program..\n')
+	RootFileName = Path(RootFile).name
+	RootFileParent = Path(RootFile).parent
+
+
+	## Open Tree ##
+	try:
+		# trees can sit at any depth, resolved from the key index of the file
+		with Report.stage('open'):
+			TreeName = resolve_tree(TFile, TreeName)
+			Tree = TFile.Get(TreeName)
+		file_branchnames = []
+		Branches = Tree.GetListOfBranches()
+
+		if Verbose:
+			print('Number of branches in file: {}\n'.format(len(Branches)))
+			for branch in Branches:
+				file_branchnames.append(str(branch.GetFullName()))
+				print('    {}'.format(file_branchnames[-1]))
+		else:
+			for branch in Branches:
+				file_branchnames.append(str(branch.GetFullName()))
+
+	except AmbiguousTreeError as err:
+		sys.exit('{}\n'.format(err))
+	except ReferenceError as re:
+		print('TFile.GetKey({})'.format(TreeName))
+		print('Returned a null pointer. Tree with name {}'.format(TreeName))
+		print('does not exist in file {}\n'.format(RootFileName))
+		sys.exit()
+
+
+								###################
+								## COPY BRANCHES ##
+								###################
+	#=============================================================================#
+	leftover_branches = []
+	for filebranch in file_branchnames:
+		FoundBranch = False
+		for branch in inclusive_branches:
+			if branch == filebranch:
+				FoundBranch = True
+				break
+		if FoundBranch == False:
+			leftover_branches.append(filebranch)
+	#=============================================================================#
+
+	print('\n'+'-'*54)
+	print('-- Creating Copy Trees with the following variables --')
+	print('-'*54)
+	branches_not_in = []
+	renames = dict()
+
+	print('\n -- changes')
+	for oldbranch, newbranch in zip(OldBranches, NewBranches):
+		if not oldbranch in file_branchnames:
+			branches_not_in.append(oldbranch)
+			continue
+		print('	{:25s} ==> {}'.format(oldbranch, newbranch))
+		renames[oldbranch] = newbranch
+
+	print('\n -- copying branches')
+	if FriendMode:
+		print('	none, friend of {}'.format(RootFile))
+	for branch in same_branches:
+		print('	{}'.format(branch))
+
+	print('\n -- left over branches not copied')
+	for branch in leftover_branches:
+		print('	{}'.format(branch))
+
+	print('\n -- branches not in original tree')
+	for branch in branches_not_in:
+		print('	{}'.format(branch))
+
+	NewRootFileName = renamed_filename(RootFile, SaveFolder, Suffix)
+	print('\nSaving new tree to: {}'.format(NewRootFileName))
+
+	if not args.yes:
+		usr_input = input('\nWould you like to continue? (y/n)\n')
+		if usr_input != 'y':
+			sys.exit('\nExiting early.\n')
+
+	KeptBranches = [b for b in same_branches if b in file_branchnames]
+	set_tree_cache(Tree, args.tree_cache_size, list(renames) + KeptBranches
+		if args.tree_cache_used_only else None)
+
+	# fast cloning copies baskets, timed as the event loop all the same
+	with Report.stage('event_loop'), atomic_outputs(NewRootFileName) as Temps:
+		Mode, Reason = rename_tree(Tree, Temps[0], TreeName, renames,
+			KeptBranches, Casts, FastClone, WriteOptions, args.progress)
+	Manifest.record(NewRootFileName, [RootFile], Options)
+	Manifest.save()
+	if Reason is not None:
+		print('\nCould not fast clone ({}), used RDataFrame.'.format(Reason))
+	print('\nFinished saving copy ({}).\n'.format(Mode))
+	print_read_stats()
+
+	Entries = int(Tree.GetEntries())
+	with Report.stage('close'):
+		TFile.Close()
+	if args.report is not None:
+		Report.update(input=RootFile, tree=TreeName, entries=Entries, mode=Mode,
+			fallback=Reason,
+			outputs={NewRootFileName: os.path.getsize(NewRootFileName)})
+		Report.save(args.report)
@@ -7,41 +7,23 @@ author: Russell Bate
 email: russell.bate@cern.ch, russellbate@phas.ubc.ca
 '''
 
-import ROOT
 import argparse, sys, os
-import numpy as np
 from pathlib import Path
 import utils
-from utils import return_tdir
-#ROOT.gInterpreter.GenerateDictionary("vector<vector<float>>")
-#ROOT.gROOT.ProcessLine("#include <vector>")
-#ROOT.gROOT.ProcessLine("#include RVec")
-ROOT.gInterpreter.Declare(
-"""
-#ifdef __CLING__
-#pragma link C++ class ROOT::VecOps::RVec<float>
-#pragma link C++ class ROOT::VecOps::RVec<vector<float>>)
-#endif
-
-#include<ROOT/RVec.hxx>
-""")
-ROOT.gInterpreter.GenerateDictionary("ROOT::RVec<vector<float> >","vector;ROOT/RVec.hxx")
+from utils import resolve_tree, key_index, cluster_aligned_end, \
+    range_dataframe, shard_filters, snapshot_options, branch_type, \
+    load_dictionary, select_columns, track_progress, sample_columns, \
+    stratum_counts, sample_filter, flatten_nested, set_tree_cache, \
+    used_branches, print_read_stats, AmbiguousTreeError
+from cli import add_snapshot_args, write_options_from_args, add_column_args, \
+    add_report_args, RunReport, add_manifest_args, open_manifest, \
+    tool_options, add_tree_cache_args, set_read_cache_env
+from manifest import atomic_outputs
 
 print('\n' + '='*25)
 print('== DOWNSIZE ROOT FILES ==')
 print('='*25 + '\n')
 
-## FUNCTIONS ##
-def open_rfile(rfilename):
-    success = True
-    try:
-        f = ROOT.TFile.Open(rfilename)
-        return f
-    except OSError as ose:
-        print('Caught OSError: \n{} \n'.format(ose))
-        return None
-
-
 ## ARGPARSING ##
 parser = argparse.ArgumentParser(
                     prog = 'split_trees',
@@ -49,7 +31,7 @@ parser = argparse.ArgumentParser(
                     +'downsampled files. Unless events is given, it takes '\
                     +'10% of the existing file.',
                     epilog = 'Warning: this code should be used after all '\
-                    +'trees have been combined!')
+                    +'trees have been combined (see merge_trees.py)!')
 parser.add_argument('rootfile', # positional argument
                     help='ROOT file to split to something smaller.')
 parser.add_argument('--savestring', dest='savestring', action='store',
@@ -72,6 +54,57 @@ parser.add_argument('--filename', dest='filename', action='store',
 parser.add_argument('--events', dest='events', action='store',
                     default=None, type=int,
                     help='Number events to downsample to.')
+parser.add_argument('--align-clusters', dest='align_clusters',
+                    action='store_true', default=False,
+                    help='Round the number of events up to the next cluster '\
+                    +'boundary so only whole clusters are read.')
+shard_group = parser.add_argument_group('shard_group')
+shard_group.add_argument('--shards', dest='shards', action='store',
+                    default=None, type=int,
+                    help='Split the input into this many equal shards, '\
+                    +'written in a single event loop.')
+shard_group.add_argument('--fractions', dest='fractions', action='store',
+                    default=None, type=float, nargs='+',
+                    help='Split the input into shards of these fractions, '\
+                    +'e.g. 0.8 0.1 0.1 for train/val/test.')
+shard_group.add_argument('--shard-names', dest='shard_names', action='store',
+                    default=None, type=str, nargs='+',
+                    help='Labels appended to the shard file names. Default '\
+                    +'is shard0, shard1, ...')
+shard_group.add_argument('--shard-key', dest='shard_key', action='store',
+                    default=None, type=str,
+                    help='Integer column (e.g. eventNumber) deciding the '\
+                    +'shard of each entry. Default is contiguous blocks of '\
+                    +'entries, which needs the entry numbers in order and '\
+                    +'so turns multithreading off.')
+sample_group = parser.add_argument_group('sample_group')
+sample_group.add_argument('--cut', dest='cut', action='store',
+                    default=[], type=str, nargs='+',
+                    help='Selections as RDataFrame filter expressions, e.g. '\
+                    +'"pt0 > 50" "abs(eta0) < 2.5". Without --random they '\
+                    +'apply to the first --events entries.')
+sample_group.add_argument('--random', dest='random', action='store_true',
+                    help='Keep --events entries passing the cuts chosen at '\
+                    +'random over the whole tree instead of the first ones. '\
+                    +'A prepass over the cut columns estimates the rates.')
+sample_group.add_argument('--seed', dest='seed', action='store',
+                    default=0, type=int,
+                    help='Seed of the random selection.')
+sample_group.add_argument('--sample-key', dest='sample_key', action='store',
+                    default=None, type=str,
+                    help='Integer column (e.g. eventNumber) hashed for the '\
+                    +'random selection, reproducible independently of the '\
+                    +'entry order. Default is the entry number, which '\
+                    +'needs the entries in order and so turns '\
+                    +'multithreading off.')
+sample_group.add_argument('--stratify', dest='stratify', action='store',
+                    default=None, type=str,
+                    help='Balance the random selection across the values of '\
+                    +'this column (e.g. RunNumber), or its --strata-edges '\
+                    +'bins. Implies --random.')
+sample_group.add_argument('--strata-edges', dest='strata_edges',
+                    action='store', default=None, type=float, nargs='+',
+                    help='Bin edges of the --stratify column, e.g. pt0 bins.')
 parser.add_argument('--multithreading', default=True,
                     action=argparse.BooleanOptionalAction,
                     help='Use ROOT multithreading. '\
@@ -80,9 +113,24 @@ parser.add_argument('--CPUS', action='store',
                     type=int, default=8,
                     help='Number of CPUS, maximum 10 for now.')
 
+add_snapshot_args(parser)
+column_group = add_column_args(parser)
+column_group.add_argument('--flatten-nested', dest='flatten_nested',
+                    action='store_true',
+                    help='Write each vector<vector<T>> branch as NAME_n '\
+                    +'(inner vectors), NAME_offsets (n+1 start positions) '\
+                    +'and NAME_values (all values), which needs no '\
+                    +'dictionary to write or read.')
+add_tree_cache_args(parser)
+add_report_args(parser)
+add_manifest_args(parser)
+
 # argparsing
 args = parser.parse_intermixed_args()
 
+# only import ROOT once the arguments are fine, --help stays fast
+import ROOT
+
 rfilename = args.rootfile
 Savestring = args.savestring
 SaveFolder = args.savefolder
@@ -90,8 +138,27 @@ NewFileName = args.filename
 TreeName = args.treename
 SaveTreeName = args.save_treename
 Events = args.events
+AlignClusters = args.align_clusters
 MultiThreading = args.multithreading
 CPUS = args.CPUS
+Fractions = args.fractions
+ShardNames = args.shard_names
+ShardKey = args.shard_key
+WriteOptions = write_options_from_args(args)
+Cuts = args.cut
+Random = args.random or args.stratify is not None
+Report = RunReport('split_trees', input=rfilename)
+
+if args.shards is not None:
+    if Fractions is not None:
+        sys.exit('\nGive either --shards or --fractions, not both.\n')
+    Fractions = [1. / args.shards] * args.shards
+Sharding = Fractions is not None
+if Sharding:
+    if ShardNames is None:
+        ShardNames = ['shard{}'.format(i) for i in range(len(Fractions))]
+    if len(ShardNames) != len(Fractions):
+        sys.exit('\n--shard-names needs one name per shard.\n')
 
 ParentDir = Path(rfilename).parent
 RootFile_lone = Path(rfilename).name
@@ -99,8 +166,22 @@ RootFile_lone = Path(rfilename).name
 if TreeName is None:
     TreeName = 'tree'
 
+# contiguous shards are blocks of rdfentry_, which only follows the tree
+# entry number in single threaded loops
+if MultiThreading and Sharding and ShardKey is None:
+    print('Contiguous shards need the entry order, multithreading is off '\
+        +'(give --shard-key to keep it).')
+    MultiThreading = False
+# the same for the default sampling hash key, the prepass and the writing
+# loop must also see the same entry -> hash mapping
+if MultiThreading and Random and args.sample_key is None:
+    print('Random sampling by entry number needs the entry order, '\
+        +'multithreading is off (give --sample-key to keep it).')
+    MultiThreading = False
+
 if MultiThreading:
     ROOT.EnableImplicitMT(CPUS)
+set_read_cache_env(args)
 
 if SaveFolder is None:
     
@@ -120,9 +201,11 @@ else:
 
 
 # check if root file exists
+NestedBranches = set()
 try:
     try:
-        f = ROOT.TFile.Open(rfilename)
+        with Report.stage('open'):
+            f = ROOT.TFile.Open(rfilename)
     except OSError as ose:
         print('Caught system error:\n')
         print(ose)
@@ -130,22 +213,16 @@ try:
     # check how many events are in rootfile
 
     try:
-        keys = f.GetListOfKeys()
-        keynames = [key.GetName() for key in keys]
-        if not TreeName in keynames:
-            tdir = return_tdir(keys)
-            keys = tdir.GetListOfKeys()
-            keynames = [key.GetName() for key in keys]
-            TreeName_child = TreeName.split('/')[-1]
-            if not TreeName_child in keynames:
-                raise KeyError
-            tree = tdir.GetKey(TreeName_child).ReadObj()
-            print(f'Successfully loaded tree {tree.ClassName()}')
-        else:
-            tree = f.GetKey(TreeName).ReadObj()
-            print(f'Successfully loaded tree {tree.ClassName()}')
+        # trees can sit at any depth, the key index finds them by full
+        # path or by their name alone
+        TreeName = resolve_tree(f, TreeName)
+        with Report.stage('open'):
+            tree = f.Get(TreeName)
+        print(f'Successfully loaded tree {tree.ClassName()}: {TreeName}')
 
         NinTree = tree.GetEntriesFast()
+        NestedBranches = set(str(b.GetName()) for b in tree.GetListOfBranches()
+            if 'vector<vector<' in branch_type(b).replace(' ', ''))
     
         if not Events is None:
             if Events >= NinTree:
@@ -154,21 +231,27 @@ try:
                     +'total of {} in file.\n'.format(NinTree))
 
         # maybe do some user input here
+        elif Sharding:
+            print('No number of events given, sharding the whole tree.')
+            Events = NinTree
         else:
             print('No number of events given, defaulting to 10%.')
             Events = int(.1 * NinTree)
 
-    except KeyError as ke:
-        print(f'No key with Key Name: \'{TreeName}\' exists!')
-        print(f'Available keys: {keynames}')
+        if AlignClusters:
+            Events = cluster_aligned_end(tree, Events)
+            print('Aligned to cluster boundary: {} events.'.format(Events))
+
+    except AmbiguousTreeError as err:
         f.Close()
-        raise ke
+        sys.exit('{}\n'.format(err))
     except ReferenceError as re:
         print(f'No key with Key Name: \'{TreeName}\' exists!')
-        print(f'Available keys: {keynames}')
+        print(f'Available trees: {key_index(f).trees()}')
         f.Close()
+        raise re
 
-    f.Close()
+    # f stays open, the event loop reuses the tree read here
 
 except OSError as ose:
     print('Cannot open root file: \n{}\n'.format(rfilename)\
@@ -192,19 +275,125 @@ else:
 if SaveTreeName is None:
     SaveTreeName = 'tree'
 
-df = ROOT.RDataFrame(TreeName, rfilename)
-print('saving to: {}\n'.format(NewFileName))
+# a random selection loops over the whole tree, otherwise the first entries
+LoopEntries = NinTree if Random else Events
+if LoopEntries < NinTree:
+    df = range_dataframe(TreeName, rfilename, Events, tree=tree)
+else:
+    df = ROOT.RDataFrame(tree)
+LoopDF = df
 
-ColumnNames = list(df.GetColumnNames())
+# only the selected columns are read by the event loop and written
+ColumnNames = select_columns(df.GetColumnNames(), include=args.include,
+    exclude=args.exclude, include_regex=args.include_regex,
+    exclude_regex=args.exclude_regex)
+if len(ColumnNames) == 0:
+    sys.exit('\nNo branches selected, exiting program..\n')
 print('Column Names:')
 print(ColumnNames)
 
-if not MultiThreading:
-    df = df.Filter(f'rdfentry_<={Events}')
-    df.Snapshot(SaveTreeName, NewFileName, ColumnNames)
-    print('\n\tdone!\n')
+SelectedColumns = list(ColumnNames)
+
+if not Sharding:
+    OutFiles = [NewFileName]
 else:
-    df = df.Filter('rdfentry_<={}'.format(Events))
-    df.Snapshot(SaveTreeName, NewFileName, df.GetColumnNames())
-    print('\n\tdone!\n')
+    OutFiles = [NewFileName.replace('.root', '_{}.root'.format(name))
+        for name in ShardNames]
+
+# outputs are skipped when the manifest shows the same input and options,
+# checked before anything (prepass, dictionary) reads or compiles
+Manifest = open_manifest(args, SaveFolder)
+Options = dict(tool_options(args), tree=TreeName, events=Events,
+    columns=SelectedColumns)
+if not args.force and all(Manifest.is_current(name, [rfilename], Options)
+    for name in OutFiles):
+    print('Outputs are up to date, skipping (use --force to rewrite):')
+    for name in OutFiles:
+        print('    {}'.format(name))
+    f.Close()
+    sys.exit(0)
+
+if args.flatten_nested:
+    for column in sorted(NestedBranches & set(ColumnNames)):
+        df, FlatColumns = flatten_nested(df, column)
+        index = ColumnNames.index(column)
+        ColumnNames[index:index+1] = FlatColumns
+        print('flattening {} ==> {}'.format(column, FlatColumns))
+elif NestedBranches & set(ColumnNames):
+    # nested vectors are read as RVec<vector<float>>, which needs a
+    # dictionary to be written. Built once and cached.
+    with Report.stage('dictionary'):
+        load_dictionary('ROOT::RVec<vector<float> >', 'vector;ROOT/RVec.hxx')
 
+# cuts are compiled filters, the Snapshot and sampling columns come after
+for i, cut in enumerate(Cuts):
+    print('cut{}: {}'.format(i, cut))
+    df = df.Filter(cut, 'cut{}'.format(i))
+if Random:
+    df = sample_columns(df, args.seed, args.sample_key, args.stratify,
+        args.strata_edges)
+    # the prepass only reads the cut, key and stratify columns
+    with Report.stage('prepass'):
+        Counts = stratum_counts(df)
+    Expression, Targets = sample_filter(Counts, Events,
+        stratified=args.stratify is not None)
+    print('\n{:>12s} | {:>12s} | {:>12s}'.format('Stratum', 'Passing',
+        'Expected'))
+    for stratum in sorted(Counts):
+        print('{:>12d} | {:>12d} | {:>12.0f}'.format(stratum,
+            sum(Counts[stratum]), Targets[stratum]))
+    if sum(Targets.values()) < Events:
+        print('Only {:.0f} entries pass the cuts.'.format(sum(
+            Targets.values())))
+    print()
+    df = df.Filter(Expression, 'sample')
+
+# the loop reads the written branches and those of the cuts and sampling
+UsedBranches = sorted(set(SelectedColumns) | set(used_branches(
+    [str(b.GetName()) for b in tree.GetListOfBranches()],
+    Cuts + [args.sample_key or '', args.stratify or ''])))
+set_tree_cache(tree, args.tree_cache_size,
+    UsedBranches if args.tree_cache_used_only else None)
+if MultiThreading and (args.tree_cache_size is not None or
+    args.tree_cache_used_only):
+    print('Note: multithreaded loops open their own trees, --tree-cache-size '\
+        +'and --tree-cache-used-only only apply with --no-multithreading.')
+
+if args.progress:
+    Progress = track_progress(LoopDF, LoopEntries)
+
+# written under temporary names, renamed once the event loop succeeded
+with atomic_outputs(*OutFiles) as TempFiles:
+    if not Sharding:
+        print('saving to: {}\n'.format(NewFileName))
+        # JIT compilation and writing happen inside the event loop
+        with Report.stage('event_loop'):
+            df.Snapshot(SaveTreeName, TempFiles[0], ColumnNames,
+                snapshot_options(**WriteOptions))
+    else:
+        # book every shard lazily so they are all written in one event loop
+        opts = snapshot_options(lazy=True, **WriteOptions)
+        Snapshots = []
+        for name, expr, ShardFileName, TempFile in zip(ShardNames,
+            shard_filters(Fractions, LoopEntries, key=ShardKey), OutFiles,
+            TempFiles):
+            print('saving shard {} ({}) to: {}'.format(name, expr,
+                ShardFileName))
+            Snapshots.append(df.Filter(expr, name).Snapshot(SaveTreeName,
+                TempFile, ColumnNames, opts))
+        print()
+        with Report.stage('event_loop'):
+            Snapshots[0].GetValue()
+print('\n\tdone!\n')
+print_read_stats()
+
+for name in OutFiles:
+    Manifest.record(name, [rfilename], Options)
+Manifest.save()
+
+with Report.stage('close'):
+    f.Close()
+if args.report is not None:
+    Report.update(tree=TreeName, entries=LoopEntries, columns=len(ColumnNames),
+        outputs={name: os.path.getsize(name) for name in OutFiles})
+    Report.save(args.report)
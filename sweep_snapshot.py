@@ -0,0 +1,141 @@
+#!/bin/bash
+#!/cvmfs/sft.cern.ch/lcg/views/LCG_101_ATLAS_26/x86_64-centos7-gcc11-opt/bin/python
+
+'''
+Script to compare Snapshot write settings (compression, basket size, auto
+flush) on a sample of a tree. Reports write throughput, read-back throughput
+and file size for each setting.
+author: Russell Bate
+email: russell.bate@cern.ch, russellbate@phas.ubc.ca
+'''
+
+import argparse, sys, os, json, time, itertools, tempfile
+from utils import open_rfile, resolve_tree, AmbiguousTreeError, \
+    range_dataframe, snapshot_options, read_all_entries, SNAPSHOT_ALGORITHMS
+
+
+## ARGPARSING ##
+parser = argparse.ArgumentParser(
+                    prog = 'sweep_snapshot',
+                    description = 'Writes a sample of a tree with several '\
+                    +'Snapshot settings and reports write throughput, '\
+                    +'read-back throughput and file size for each.')
+parser.add_argument('rootfile', # positional argument
+                    help='ROOT file to take the sample from.')
+parser.add_argument('--tree-name', dest='tree_name', action='store',
+                    default='tree', type=str,
+                    help='Name of the tree, i.e. tname or dir/tname.')
+parser.add_argument('--events', dest='events', action='store',
+                    default=10000, type=int,
+                    help='Number of entries in the sample.')
+parser.add_argument('--algorithms', dest='algorithms', action='store',
+                    default=SNAPSHOT_ALGORITHMS, type=str, nargs='+',
+                    choices=SNAPSHOT_ALGORITHMS,
+                    help='Compression algorithms to try.')
+parser.add_argument('--levels', dest='levels', action='store',
+                    default=[1, 5, 9], type=int, nargs='+',
+                    help='Compression levels to try.')
+parser.add_argument('--basket-sizes', dest='basket_sizes', action='store',
+                    default=[None], type=int, nargs='+',
+                    help='Basket sizes in bytes to try (ROOT >= 6.30).')
+parser.add_argument('--auto-flush', dest='auto_flush', action='store',
+                    default=[None], type=int, nargs='+',
+                    help='Auto flush values to try.')
+parser.add_argument('--savefolder', dest='savefolder', action='store',
+                    default=None, type=str,
+                    help='Folder for the sample files. Default is a '\
+                    +'temporary folder.')
+parser.add_argument('--keep', dest='keep', action='store_true',
+                    help='Keep the sample files.')
+parser.add_argument('--json-out', dest='json_out', action='store',
+                    default=None, type=str,
+                    help='Write the results to this JSON file.')
+args = parser.parse_intermixed_args()
+
+import ROOT
+
+RootFile = args.rootfile
+TreeName = args.tree_name
+Events = args.events
+
+SaveFolder = args.savefolder
+if SaveFolder is None:
+    SaveFolder = tempfile.mkdtemp(prefix='sweep_snapshot_')
+elif not os.path.exists(SaveFolder):
+    raise ValueError('{} does not exist.'.format(SaveFolder))
+
+
+## MAIN ##
+print('\n'+'-'*80)
+print('-- Sweeping Snapshot settings for: {}'.format(RootFile))
+print('-'*80+'\n')
+
+TFile = open_rfile(RootFile)
+if TFile is None:
+    sys.exit('\nCannot open TFile, exiting program..\n')
+try:
+    # RDataFrame needs the full path of a tree in a directory
+    TreeName = resolve_tree(TFile, TreeName)
+    NinTree = TFile.Get(TreeName).GetEntries()
+except AmbiguousTreeError as err:
+    sys.exit('{}\n'.format(err))
+except ReferenceError as err:
+    sys.exit('Tree with name {} does not exist in file {}\n'.format(
+        TreeName, RootFile))
+TFile.Close()
+Events = min(Events, NinTree)
+print('Sample of {} entries, files in {}\n'.format(Events, SaveFolder))
+
+# warm up the page cache so the first setting is not penalised
+range_dataframe(TreeName, RootFile, Events).Count().GetValue()
+
+Results = []
+for algorithm, level, basket_size, autoflush in itertools.product(
+    args.algorithms, args.levels, args.basket_sizes, args.auto_flush):
+    setting = dict(algorithm=algorithm, level=level, basket_size=basket_size,
+        autoflush=autoflush)
+    outname = os.path.join(SaveFolder, 'sample_{}_{}_{}_{}.root'.format(
+        algorithm, level, basket_size, autoflush))
+
+    df = range_dataframe(TreeName, RootFile, Events)
+    start = time.perf_counter()
+    df.Snapshot('tree', outname, df.GetColumnNames(),
+        snapshot_options(**setting))
+    write_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    OutFile = ROOT.TFile.Open(outname)
+    Tree = OutFile.Get('tree')
+    nbytes = read_all_entries(Tree)
+    read_time = time.perf_counter() - start
+    OutFile.Close()
+
+    Results.append(dict(setting,
+        file_size = os.path.getsize(outname),
+        write_time = write_time,
+        write_events_per_s = Events / write_time,
+        read_time = read_time,
+        read_events_per_s = Events / read_time,
+        read_mb_per_s = nbytes / read_time / 1e6))
+    if not args.keep:
+        os.remove(outname)
+
+print('{:>6s} {:>5s} {:>11s} {:>10s} | {:>12s} | {:>12s} | {:>12s} | {:>9s}'\
+    .format('Algo', 'Level', 'Basket', 'AutoFlush', 'Size (MB)',
+    'Write ev/s', 'Read ev/s', 'Read MB/s'))
+print('-'*96)
+for result in sorted(Results, key=lambda r: -r['read_events_per_s']):
+    print('{:>6s} {:>5d} {:>11s} {:>10s} | {:>12.2f} | {:>12.0f} | {:>12.0f}'\
+        ' | {:>9.1f}'.format(result['algorithm'], result['level'],
+        str(result['basket_size']), str(result['autoflush']),
+        result['file_size'] / 1e6, result['write_events_per_s'],
+        result['read_events_per_s'], result['read_mb_per_s']))
+print('\nWrite times include reading the sample from the input file.\n')
+
+if args.json_out is not None:
+    with open(args.json_out, 'w') as f:
+        json.dump(dict(file=RootFile, tree=TreeName, events=Events,
+            results=Results), f, indent=2)
+    print('Saved results to {}\n'.format(args.json_out))
+if not args.keep and args.savefolder is None:
+    os.rmdir(SaveFolder)
@@ -0,0 +1,4 @@
+import os, sys
+
+# the tools are scripts next to utils.py, not an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,30 @@
+from compare_rootfiles import branch_pairs
+
+
+def branches(**types):
+    return [dict(name=name, type=typename, entries=10)
+        for name, typename in types.items()]
+
+
+def test_branch_pairs_matching_schema():
+    pairs, schema = branch_pairs(branches(pt='Float_t', n='Long_t'),
+        branches(pt='Float_t', n='Long_t'))
+    assert pairs == [('pt', 'pt', 'float', 'float'), ('n', 'n', 'long', 'long')]
+    assert not (schema['missing'] or schema['retyped'] or
+        schema['unsupported'] or schema['extra'])
+
+
+def test_branch_pairs_cast_keeps_pair():
+    pairs, schema = branch_pairs(branches(pt='Float_t'),
+        branches(jetPt='Double_t'), renames={'pt': 'jetPt'},
+        casts={'jetPt': 'double'})
+    assert pairs == [('pt', 'jetPt', 'float', 'double')]
+    assert schema['retyped'] == []
+
+
+def test_branch_pairs_cast_changing_nesting_is_unsupported():
+    pairs, schema = branch_pairs(branches(pt='vector<float>'),
+        branches(jetPt='Double_t'), renames={'pt': 'jetPt'},
+        casts={'jetPt': 'double'})
+    assert pairs == []
+    assert schema['unsupported'] == [['pt', 'jetPt']]
@@ -0,0 +1,21 @@
+import sys
+from utils import histogram_range
+
+DBL_MAX = sys.float_info.max
+
+
+def test_histogram_range_pads_sampled_extremes():
+    assert histogram_range(0., 100.) == (-1., 101.)
+
+
+def test_histogram_range_constant_column():
+    lo, hi = histogram_range(3., 3.)
+    assert lo < 2.5 and hi > 3.5
+
+
+def test_histogram_range_nothing_sampled():
+    # RDataFrame Min/Max of a column without values
+    assert histogram_range(DBL_MAX, -DBL_MAX) is None
+    assert histogram_range(float('inf'), float('-inf')) is None
+    assert histogram_range(float('nan'), 1.) is None
+    assert histogram_range(-DBL_MAX, DBL_MAX) is None
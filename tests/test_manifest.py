@@ -0,0 +1,59 @@
+import os
+import pytest
+from manifest import Manifest, atomic_outputs, temp_name
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+    return str(path)
+
+
+def recorded(tmp_path, options):
+    rfile = write(tmp_path / 'in.root', 'input')
+    output = write(tmp_path / 'out.root', 'output')
+    manifest = Manifest(str(tmp_path / 'manifest.json'))
+    manifest.record(output, [rfile], options)
+    return manifest, rfile, output
+
+
+def test_is_current_until_input_option_or_output_change(tmp_path):
+    options = dict(compression='zstd', level=5)
+    manifest, rfile, output = recorded(tmp_path, options)
+    assert manifest.is_current(output, [rfile], options)
+    assert not manifest.is_current(output, [rfile], dict(options, level=6))
+
+    write(output, 'changed output')
+    assert not manifest.is_current(output, [rfile], options)
+
+    manifest, rfile, output = recorded(tmp_path, options)
+    write(rfile, 'changed input')
+    assert not manifest.is_current(output, [rfile], options)
+
+
+def test_save_keeps_entries_on_disk(tmp_path):
+    path = str(tmp_path / 'manifest.json')
+    rfile = write(tmp_path / 'in.root', 'input')
+    first = Manifest(path)
+    second = Manifest(path)
+    out_a = write(tmp_path / 'a.root', 'a')
+    out_b = write(tmp_path / 'b.root', 'b')
+    first.record(out_a, [rfile], dict())
+    first.save()
+    # second was loaded before the first save, it must not drop out_a
+    second.record(out_b, [rfile], dict())
+    second.save()
+    reloaded = Manifest(path)
+    assert reloaded.is_current(out_a, [rfile], dict())
+    assert reloaded.is_current(out_b, [rfile], dict())
+
+
+def test_atomic_outputs_removes_temporary_on_error(tmp_path):
+    output = str(tmp_path / 'out.root')
+    with pytest.raises(RuntimeError):
+        with atomic_outputs(output) as temps:
+            assert temps == [temp_name(output)]
+            write(temps[0], 'partial')
+            raise RuntimeError('killed')
+    assert not os.path.exists(temp_name(output))
+    assert not os.path.exists(output)
@@ -0,0 +1,36 @@
+from metacache import MetadataCache
+
+
+def put_files(tmp_path, cache, n):
+    for i in range(n):
+        rfilename = str(tmp_path / 'f{}.root'.format(i))
+        with open(rfilename, 'w') as f:
+            f.write('x')
+        cache.put(rfilename, trees={'tree': {'entries': i, 'pad': 'y'*200}})
+
+
+def test_put_get_roundtrip(tmp_path):
+    cache = MetadataCache(tmp_path / 'cache')
+    put_files(tmp_path, cache, 1)
+    record = cache.get(str(tmp_path / 'f0.root'))
+    assert record['trees']['tree']['entries'] == 0
+
+
+def test_cache_stays_below_limit(tmp_path):
+    cache = MetadataCache(tmp_path / 'cache', max_mb=0.002)
+    put_files(tmp_path, cache, 50)
+    sizes = [p.stat().st_size for p in (tmp_path / 'cache').glob('*.json')]
+    assert 0 < sum(sizes) <= cache.max_bytes
+    # the newest record survives the eviction
+    assert cache.get(str(tmp_path / 'f49.root')) is not None
+
+
+def test_evict_only_when_over_estimate(tmp_path, monkeypatch):
+    cache = MetadataCache(tmp_path / 'cache')
+    scans = []
+    evict = MetadataCache.evict
+    monkeypatch.setattr(MetadataCache, 'evict',
+        lambda self: scans.append(1) or evict(self))
+    put_files(tmp_path, cache, 20)
+    # one scan to seed the estimate, none after while the cache fits
+    assert len(scans) == 1
@@ -0,0 +1,53 @@
+import pytest
+from utils import SAMPLE_BITS, stratified_targets, hash_threshold, \
+    sample_thresholds
+
+WIDTH = 1 << (64 - SAMPLE_BITS)
+
+
+def flat_counts(per_bucket):
+    return [per_bucket] * (1 << SAMPLE_BITS)
+
+
+def test_stratified_targets_even_split():
+    assert stratified_targets({1: 100, 2: 100}, 50) == {1: 25, 2: 25}
+
+
+def test_stratified_targets_small_strata_taken_whole():
+    targets = stratified_targets({1: 10, 2: 100, 3: 1000}, 300)
+    assert targets == {1: 10, 2: 100, 3: 190}
+
+
+def test_stratified_targets_more_than_available():
+    assert stratified_targets({1: 10, 2: 20}, 100) == {1: 10, 2: 20}
+
+
+def test_hash_threshold_interpolates_in_bucket():
+    counts = [0] * (1 << SAMPLE_BITS)
+    counts[0] = counts[1] = 10
+    assert hash_threshold(counts, 15) == WIDTH + WIDTH // 2
+    assert hash_threshold(counts, 10) == WIDTH
+
+
+def test_hash_threshold_limits():
+    counts = flat_counts(1)
+    assert hash_threshold(counts, 0) == 0
+    assert hash_threshold(counts, len(counts) + 1) == (1 << 64) - 1
+
+
+def test_sample_thresholds_proportional():
+    counts = {0: flat_counts(1), 1: flat_counts(3)}
+    thresholds, targets = sample_thresholds(counts, 1 << SAMPLE_BITS)
+    assert targets[0] == pytest.approx((1 << SAMPLE_BITS) / 4)
+    assert targets[1] == pytest.approx(3 * (1 << SAMPLE_BITS) / 4)
+    # uniform hashes: both strata keep the same fraction of the hash range
+    assert thresholds[0] == thresholds[1] == (1 << 64) // 4
+
+
+def test_sample_thresholds_stratified_capped():
+    counts = {0: flat_counts(1), 1: flat_counts(10)}
+    thresholds, targets = sample_thresholds(counts, 4 * (1 << SAMPLE_BITS),
+        stratified=True)
+    assert targets[0] == 1 << SAMPLE_BITS
+    assert targets[1] == 3 * (1 << SAMPLE_BITS)
+    assert thresholds[0] == (1 << 64) - 1
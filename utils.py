@@ -1,5 +1,21 @@
-import ROOT
-import numpy as np
+import os, re, sys, glob, math, time, hashlib, shutil
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from metacache import MetadataCache
+import manifest
+
+DIRECTORY_CLASSES = ('TDirectoryFile', 'TDirectory')
+
+def open_rfile(rfilename):
+    ''' Handles error if opening fails (In python OSError) 
+    returns None if ROOT cannot open the file. '''
+    import ROOT
+    try:
+        f = ROOT.TFile.Open(rfilename)
+        return f
+    except OSError as ose:
+        print('Caught OSError: \n{} \n'.format(ose))
+        return None
 
 def print_obj_info(obj, key, nspc=4):
     print(' '*nspc+'Object: {}'.format(obj.ClassName()))
@@ -8,19 +24,1090 @@ def print_obj_info(obj, key, nspc=4):
     print(' '*nspc+'Size: {} (NBytes)'.format(key.GetNbytes()))
     return None
 
-def inspect_keys(keylist, nspc=4):
+def key_info(key, path=''):
+    ''' Returns a dictionary describing the key using only the TKey
+    metadata, no payload is read from disk. '''
+    return dict(
+        name = str(key.GetName()),
+        title = str(key.GetTitle()),
+        classname = str(key.GetClassName()),
+        cycle = int(key.GetCycle()),
+        nbytes = int(key.GetNbytes()),
+        objlen = int(key.GetObjlen()),
+        path = path)
+
+def print_key_info(info, nspc=4):
+    print(' '*nspc+'Object: {}'.format(info['classname']))
+    print(' '*nspc+'Title: {}'.format(info['title']))
+    print(' '*nspc+'Name: {};{}'.format(info['name'], info['cycle']))
+    print(' '*nspc+'Path: {}'.format(info['path']))
+    print(' '*nspc+'Size: {} (NBytes), {} (uncompressed)'.format(
+        info['nbytes'], info['objlen']))
+    return None
+
+def is_directory_key(key):
+    return key.GetClassName() in DIRECTORY_CLASSES
+
+def inspect_keys(keylist, nspc=4, read_obj=False, tdir=None, path=''):
+    ''' Lists the keys and recurses into directories. Unless read_obj is
+    set, everything is answered from the key metadata. tdir is the directory
+    holding keylist and is only needed to descend into subdirectories. '''
     print(' '*nspc+'Listing content of keys')
     for j, key in enumerate(keylist):
-        obj = key.ReadObj()
-        print_obj_info(obj, key, nspc=nspc)
+        keypath = '{}/{}'.format(path, key.GetName()) if path \
+            else str(key.GetName())
+        if read_obj:
+            obj = key.ReadObj()
+            print_obj_info(obj, key, nspc=nspc)
+        else:
+            print_key_info(key_info(key, path=keypath), nspc=nspc)
+        if is_directory_key(key) and tdir is not None:
+            subdir = tdir.GetDirectory(key.GetName())
+            inspect_keys(subdir.GetListOfKeys(), nspc=nspc+2,
+                read_obj=read_obj, tdir=subdir, path=keypath)
     return None
 
-def return_tdir(keys):
-    tdir = None
-    for key in keys:
-        obj = key.ReadObj()
-        if obj.ClassName() == 'TDirectoryFile':
-            tdir = obj
-        break
-    return tdir
+def walk_key_infos(tdir, path='', depth=0):
+    ''' Returns the key_info of every key below tdir, depth first, with the
+    nesting depth added. Only directory headers are read. '''
+    infos = []
+    for key in tdir.GetListOfKeys():
+        keypath = '{}/{}'.format(path, key.GetName()) if path \
+            else str(key.GetName())
+        info = key_info(key, path=keypath)
+        info['depth'] = depth
+        infos.append(info)
+        if is_directory_key(key):
+            infos += walk_key_infos(tdir.GetDirectory(key.GetName()),
+                path=keypath, depth=depth+1)
+    return infos
+
+_TREE_CLASSES = dict()
+
+def is_tree_class(classname):
+    import ROOT
+    if classname not in _TREE_CLASSES:
+        cl = ROOT.TClass.GetClass(classname)
+        _TREE_CLASSES[classname] = bool(cl) and bool(cl.InheritsFrom('TTree'))
+    return _TREE_CLASSES[classname]
+
+class AmbiguousTreeError(ReferenceError):
+    ''' A bare tree name matches trees in several directories. A
+    ReferenceError, so callers handling a missing tree also handle it. '''
+
+class KeyIndex:
+    ''' Path -> key metadata index of every object in a file, built once
+    by walking the keys (only directory headers are read). Trees at any
+    depth are then found with a single lookup. '''
+
+    def __init__(self, tfile):
+        self.infos = dict()
+        for info in walk_key_infos(tfile):
+            # keep the highest cycle, as TDirectory::Get does
+            known = self.infos.get(info['path'])
+            if known is None or known['cycle'] < info['cycle']:
+                self.infos[info['path']] = info
+
+    def trees(self):
+        return [path for path, info in self.infos.items()
+            if is_tree_class(info['classname'])]
+
+    def resolve(self, treename):
+        ''' Full path of treename, which is either a full path (a/b/tname)
+        or the name of a unique tree anywhere in the file. Returns None if
+        there is no such tree, raises AmbiguousTreeError if it is not
+        unique. '''
+        treename = treename.strip('/')
+        info = self.infos.get(treename)
+        if info is not None and is_tree_class(info['classname']):
+            return treename
+        matches = [path for path in self.trees()
+            if path.endswith('/' + treename)]
+        if len(matches) > 1:
+            raise AmbiguousTreeError('Tree name {} is ambiguous, give one '\
+                'of: {}.'.format(treename, matches))
+        return matches[0] if matches else None
+
+# least recently used indexes are dropped beyond KEY_INDEX_MAX
+_KEY_INDEXES = OrderedDict()
+KEY_INDEX_MAX = 64
+
+def _key_index_key(tfile):
+    # the end of the file moves when keys are written in UPDATE mode, the
+    # UUID does not
+    return (str(tfile.GetName()), str(tfile.GetUUID().AsString()),
+        int(tfile.GetEND()))
+
+def key_index(tfile):
+    ''' KeyIndex of tfile, built once per open file. '''
+    key = _key_index_key(tfile)
+    if key in _KEY_INDEXES:
+        _KEY_INDEXES.move_to_end(key)
+    else:
+        _KEY_INDEXES[key] = KeyIndex(tfile)
+        while len(_KEY_INDEXES) > KEY_INDEX_MAX:
+            _KEY_INDEXES.popitem(last=False)
+    return _KEY_INDEXES[key]
+
+def drop_key_index(tfile):
+    ''' Forgets the KeyIndex of tfile, call before closing it. '''
+    _KEY_INDEXES.pop(_key_index_key(tfile), None)
+
+def resolve_tree(tfile, treename):
+    ''' Full path of treename in tfile, see KeyIndex.resolve. Raises
+    ReferenceError if the tree does not exist, like PyROOT does for a null
+    key. '''
+    path = key_index(tfile).resolve(treename)
+    if path is None:
+        raise ReferenceError('No tree {} in {}, available trees: {}'.format(
+            treename, tfile.GetName(), key_index(tfile).trees()))
+    return path
+
+def get_tree(tfile, treename):
+    ''' Returns the tree at treename, a path of any depth (a/b/tname) or
+    the name of a unique tree anywhere in the file. Raises ReferenceError
+    if the tree does not exist. '''
+    return tfile.Get(resolve_tree(tfile, treename))
+
+def branch_type(branch):
+    ''' Class name of the branch, or the leaf type for basic types. '''
+    classname = str(branch.GetClassName())
+    if classname == '':
+        leaves = branch.GetListOfLeaves()
+        if len(leaves) > 0:
+            classname = str(leaves[0].GetTypeName())
+    return classname
+
+def tree_info(tree):
+    ''' Entry count and branch names, types and entries of tree. '''
+    branches = []
+    for branch in tree.GetListOfBranches():
+        branches.append(dict(
+            name = str(branch.GetFullName()),
+            type = branch_type(branch),
+            entries = int(branch.GetEntries())))
+    return dict(entries=int(tree.GetEntries()), branches=branches)
+
+def expand_paths(patterns):
+    ''' Expands glob patterns, directories (searched recursively for .root
+    files) and @filelist arguments into a sorted list of files. '''
+    paths = []
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            with open(pattern[1:]) as f:
+                lines = [l.strip() for l in f]
+            paths += expand_paths([l for l in lines
+                if l and not l.startswith('#')])
+        elif os.path.isdir(pattern):
+            paths += sorted(glob.glob(os.path.join(pattern, '**', '*.root'),
+                recursive=True))
+        elif glob.has_magic(pattern):
+            paths += sorted(glob.glob(pattern, recursive=True))
+        else:
+            paths.append(pattern)
+    return list(dict.fromkeys(paths))
+
+def survey_file(rfilename, treename='tree', list_content=False,
+    use_cache=True, cache_dir=None, cache_max_mb=None):
+    ''' Collects entries, branches and optionally the key layout of one
+    file as a JSON serialisable dictionary. Used as the worker of the
+    check_rootfiles batch mode, errors are reported in the result. '''
+    import ROOT
+    result = dict(file=rfilename, tree=treename, ok=False)
+    cache = None
+    if use_cache:
+        cache = MetadataCache(cache_dir) if cache_max_mb is None \
+            else MetadataCache(cache_dir, cache_max_mb)
+    record = cache.get(rfilename) if cache is not None else None
+    if record is None:
+        record = dict()
+    tree_record = record.get('trees', {}).get(treename)
+    keys = record.get('keys')
+    tfile = None
+    try:
+        if tree_record is None or (list_content and keys is None):
+            tfile = ROOT.TFile.Open(rfilename)
+            if tfile is None or tfile.IsZombie():
+                raise OSError('Cannot open TFile {}'.format(rfilename))
+            fields = dict()
+            if tree_record is None:
+                tree_record = tree_info(get_tree(tfile, treename))
+                fields['trees'] = {treename: tree_record}
+            if list_content and keys is None:
+                keys = walk_key_infos(tfile)
+                fields['keys'] = keys
+            if cache is not None:
+                cache.put(rfilename, uuid=str(tfile.GetUUID().AsString()),
+                    **fields)
+        result['entries'] = tree_record['entries']
+        result['branches'] = [dict(name=b['name'], type=b['type'])
+            for b in tree_record['branches']]
+        if list_content:
+            result['keys'] = keys
+        result['ok'] = True
+    except (OSError, ReferenceError, ValueError) as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    finally:
+        if tfile is not None:
+            tfile.Close()
+    return result
+
+def fast_entry_count(rfilename, treename='tree', use_cache=True,
+    cache_dir=None, cache_max_mb=None):
+    ''' Entry count of one file from the metadata cache, or from the tree
+    header otherwise (no baskets are read). Returns a JSON serialisable
+    result, errors included. '''
+    import ROOT
+    result = dict(file=rfilename, tree=treename, ok=False)
+    cache = None
+    if use_cache:
+        cache = MetadataCache(cache_dir) if cache_max_mb is None \
+            else MetadataCache(cache_dir, cache_max_mb)
+        record = cache.get(rfilename)
+        if record is not None and treename in record.get('trees', {}):
+            result.update(entries=record['trees'][treename]['entries'],
+                ok=True)
+            return result
+    tfile = None
+    try:
+        tfile = ROOT.TFile.Open(rfilename)
+        if tfile is None or tfile.IsZombie():
+            raise OSError('Cannot open TFile {}'.format(rfilename))
+        tree = get_tree(tfile, treename)
+        result.update(entries=int(tree.GetEntries()), ok=True)
+        if cache is not None:
+            cache.put(rfilename, uuid=str(tfile.GetUUID().AsString()),
+                trees={treename: tree_info(tree)})
+    except (OSError, ReferenceError, ValueError) as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    finally:
+        if tfile is not None:
+            tfile.Close()
+    return result
+
+def count_entries_many(rfilenames, treename='tree', jobs=None, **kwargs):
+    ''' Runs fast_entry_count over many files in a process pool, yields
+    the results as they finish. kwargs go to fast_entry_count. '''
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(fast_entry_count, rfilename, treename,
+            **kwargs) for rfilename in rfilenames]
+        for future in as_completed(futures):
+            yield future.result()
+
+def schema_summary(results):
+    ''' Dataset level summary of survey_file results. The most common
+    branch schema is the reference, every file deviating from it is listed
+    with its missing, extra and retyped branches. '''
+    good = [r for r in results if r['ok'] and 'branches' in r]
+    schemas = Counter(tuple(sorted((b['name'], b['type'])
+        for b in r['branches'])) for r in good)
+    reference = dict(schemas.most_common(1)[0][0]) if schemas else dict()
+    mismatches = []
+    for r in good:
+        schema = {b['name']: b['type'] for b in r['branches']}
+        if schema == reference:
+            continue
+        mismatches.append(dict(
+            file = r['file'],
+            missing = sorted(set(reference) - set(schema)),
+            extra = sorted(set(schema) - set(reference)),
+            retyped = sorted(name for name in set(schema) & set(reference)
+                if schema[name] != reference[name])))
+    return dict(
+        files = len(results),
+        failed = [r['file'] for r in results if not r['ok']],
+        total_entries = sum(r['entries'] for r in results if r['ok']),
+        reference_branches = len(reference),
+        schema_mismatches = mismatches)
+
+def cluster_aligned_end(tree, nentries):
+    ''' Returns the first cluster boundary at or after nentries, i.e. the
+    number of entries covering only whole clusters. '''
+    total = tree.GetEntries()
+    it = tree.GetClusterIterator(0)
+    start = it.Next()
+    while start < total:
+        end = it.GetNextEntry()
+        if end >= nentries:
+            return min(end, total)
+        start = it.Next()
+    return total
+
+def range_dataframe(treename, rfilename, nentries, tree=None):
+    ''' RDataFrame over the first nentries entries of the tree. The event
+    loop stops after them, so only the clusters holding these entries are
+    read. Range is not allowed with implicit multithreading, in that case
+    a global range dataset spec is used when available (ROOT >= 6.30) and
+    multithreading is switched off otherwise. An already read tree can be
+    given to skip reopening the file. '''
+    import ROOT
+    if ROOT.IsImplicitMTEnabled():
+        spec_cls = getattr(ROOT.RDF.Experimental, 'RDatasetSpec', None)
+        if spec_cls is not None and hasattr(spec_cls, 'WithGlobalRange'):
+            spec = spec_cls()
+            spec.AddSample(ROOT.RDF.Experimental.RSample(
+                'sample', treename, rfilename))
+            spec.WithGlobalRange(spec_cls.REntryRange(0, nentries))
+            return ROOT.RDataFrame(spec)
+        print('Entry ranges need ROOT >= 6.30 with multithreading, '\
+            +'disabling multithreading.')
+        ROOT.DisableImplicitMT()
+    if tree is not None:
+        return ROOT.RDataFrame(tree).Range(nentries)
+    return ROOT.RDataFrame(treename, rfilename).Range(nentries)
+
+def shard_filters(fractions, nentries, key=None, buckets=10000):
+    ''' Filter expressions assigning each entry to at most one shard, the
+    i-th shard getting fractions[i] of the entries. Entries are split in
+    contiguous blocks of rdfentry_ unless key is given, in which case the
+    key column modulo buckets decides, which is independent of the entry
+    order. '''
+    if any(f <= 0 for f in fractions) or sum(fractions) > 1 + 1e-9:
+        raise ValueError('Shard fractions must be positive and sum to at '\
+            +'most 1: {}.'.format(fractions))
+    if key is None:
+        variable, total = 'rdfentry_', nentries
+    else:
+        variable = '(ULong64_t({}) % {})'.format(key, buckets)
+        total = buckets
+    edges = [0]
+    for fraction in fractions:
+        edges.append(edges[-1] + fraction)
+    edges = [int(round(edge * total)) for edge in edges]
+    return ['{0} >= {1} && {0} < {2}'.format(variable, lo, hi)
+        for lo, hi in zip(edges[:-1], edges[1:])]
+
+# the top SAMPLE_BITS of the sampling hash are histogrammed by the prepass
+SAMPLE_BITS = 12
+
+def sample_columns(df, seed=0, key=None, stratify=None, edges=None):
+    ''' Defines rh_hash, a seeded 64 bit hash of key (default rdfentry_),
+    and rh_stratum, the value of the stratify column or its bin in edges
+    (0 below edges[0], len(edges) above the last edge). '''
+    declare_cpp('rh_sample_hash', """
+    ULong64_t rh_sample_hash(ULong64_t key, ULong64_t seed)
+    {
+        // splitmix64 finaliser, uniform over 64 bits for any key sequence
+        ULong64_t z = key + 0x9e3779b97f4a7c15ULL * (seed + 1);
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+        return z ^ (z >> 31);
+    }
+    """)
+    df = df.Define('rh_hash', 'rh_sample_hash(ULong64_t({}), {}ULL)'.format(
+        key or 'rdfentry_', int(seed)))
+    if stratify is None:
+        stratum = 'Long64_t(0)'
+    elif edges:
+        stratum = 'Long64_t({})'.format(' + '.join('({} >= {!r})'.format(
+            stratify, float(edge)) for edge in sorted(edges)))
+    else:
+        stratum = 'Long64_t({})'.format(stratify)
+    return df.Define('rh_stratum', stratum)
+
+def stratum_counts(df):
+    ''' Prepass over the rh_stratum and rh_hash columns: entries per
+    stratum and top SAMPLE_BITS bits of the hash, as {stratum: counts}. '''
+    import ROOT
+    count = declare_cpp('rh_stratum_counts', """
+    #include <map>
+    #include <vector>
+    #include "ROOT/RDataFrame.hxx"
+
+    std::map<Long64_t, std::vector<ULong64_t>> rh_stratum_counts(
+        ROOT::RDF::RNode df, unsigned int bits)
+    {
+        std::vector<std::map<Long64_t, std::vector<ULong64_t>>> slots(
+            df.GetNSlots());
+        df.ForeachSlot([&](unsigned int slot, Long64_t stratum,
+            ULong64_t hash) {
+            std::vector<ULong64_t> &counts = slots[slot][stratum];
+            if (counts.empty())
+                counts.resize(1ULL << bits);
+            ++counts[hash >> (64 - bits)];
+        }, {"rh_stratum", "rh_hash"});
+        for (size_t slot = 1; slot < slots.size(); ++slot)
+            for (auto &stratum : slots[slot]) {
+                std::vector<ULong64_t> &counts = slots[0][stratum.first];
+                if (counts.empty())
+                    counts.resize(1ULL << bits);
+                for (size_t b = 0; b < counts.size(); ++b)
+                    counts[b] += stratum.second[b];
+            }
+        return slots[0];
+    }
+    """)
+    return {int(pair.first): list(pair.second)
+        for pair in count(ROOT.RDF.AsRNode(df), SAMPLE_BITS)}
+
+def stratified_targets(sizes, target):
+    ''' Splits target evenly over the strata of sizes ({stratum: entries});
+    strata smaller than their share are taken whole and the rest is shared
+    by the others. '''
+    targets, remaining, left = dict(), dict(sizes), float(target)
+    while remaining:
+        share = left / len(remaining)
+        small = {s: n for s, n in remaining.items() if n <= share}
+        if not small:
+            targets.update((s, share) for s in remaining)
+            break
+        targets.update(small)
+        left -= sum(small.values())
+        for s in small:
+            del remaining[s]
+    return targets
+
+def hash_threshold(counts, target):
+    ''' rh_hash threshold below which target entries are expected, from
+    the prepass counts of one stratum. Linear inside the last bucket. '''
+    width = 1 << (64 - SAMPLE_BITS)
+    total = 0
+    for bucket, n in enumerate(counts):
+        if n > 0 and total + n >= target:
+            return min(bucket * width + int((target - total) / n * width),
+                (1 << 64) - 1)
+        total += n
+    return (1 << 64) - 1
+
+def sample_thresholds(counts, target, stratified=False):
+    ''' rh_hash thresholds per stratum keeping about target entries, spread
+    evenly over the strata when stratified and in proportion to their sizes
+    otherwise. Returns the thresholds and the expected entries. '''
+    sizes = {s: sum(c) for s, c in counts.items()}
+    if stratified:
+        targets = stratified_targets(sizes, target)
+    else:
+        total = sum(sizes.values())
+        targets = {s: min(target, total) * n / max(1, total)
+            for s, n in sizes.items()}
+    thresholds = {s: hash_threshold(counts[s], n) for s, n in targets.items()}
+    return thresholds, targets
+
+def sample_filter(counts, target, stratified=False):
+    ''' Filter expression keeping the entries below the sample_thresholds
+    of their stratum. Returns the expression and the expected entries per
+    stratum. '''
+    import ROOT
+    thresholds, targets = sample_thresholds(counts, target, stratified)
+    declare_cpp('rh_sample_threshold', """
+    #include <unordered_map>
+    std::unordered_map<Long64_t, ULong64_t> rh_sample_thresholds;
+    ULong64_t rh_sample_threshold(Long64_t stratum)
+    {
+        auto it = rh_sample_thresholds.find(stratum);
+        return it == rh_sample_thresholds.end() ? 0 : it->second;
+    }
+    """)
+    ROOT.rh_sample_thresholds.clear()
+    for stratum, threshold in thresholds.items():
+        ROOT.rh_sample_thresholds[stratum] = threshold
+    return 'rh_hash < rh_sample_threshold(rh_stratum)', targets
+
+def rename_branch(tree, oldname, newname):
+    ''' Renames a top level branch and its leaves in place, only the
+    metadata changes. '''
+    branch = tree.GetBranch(oldname)
+    branch.SetName(newname)
+    branch.SetTitle(str(branch.GetTitle()).replace(oldname, newname, 1))
+    for leaf in branch.GetListOfLeaves():
+        if str(leaf.GetName()) == oldname:
+            leaf.SetName(newname)
+        leaf.SetTitle(str(leaf.GetTitle()).replace(oldname, newname, 1))
+    return None
+
+def can_fast_rename(tree, renames, keep=()):
+    ''' Fast cloning can only rename unsplit top level branches, each copied
+    once. Returns the reason it cannot be used or None. '''
+    if len(set(renames.values())) != len(renames):
+        return 'a new branch name is used twice'
+    if set(renames) & set(keep):
+        return 'a renamed branch is also copied unchanged'
+    for oldname in renames:
+        branch = tree.GetBranch(oldname)
+        if not branch:
+            return 'branch {} not found'.format(oldname)
+        if branch.GetListOfBranches().GetEntries() > 0:
+            return 'branch {} is split into sub-branches'.format(oldname)
+    return None
+
+def fast_clone_rename(tree, outfilename, treename, renames, keep=()):
+    ''' Writes the branches in renames (old name -> new name) and keep to
+    outfilename by fast cloning: the compressed baskets are copied verbatim
+    and only the branch and leaf names are rewritten. treename may contain
+    a directory, i.e. dir/tname. '''
+    import ROOT
+    tree.SetBranchStatus('*', 0)
+    for name in list(renames) + list(keep):
+        tree.SetBranchStatus(name, 1)
+
+    outfile = ROOT.TFile.Open(outfilename, 'RECREATE')
+    outdir = outfile
+    if '/' in treename:
+        outdir = outfile.mkdir(treename.rsplit('/', 1)[0])
+    outdir.cd()
+    try:
+        newtree = tree.CloneTree(-1, 'fast')
+        newtree.SetName(treename.split('/')[-1])
+        for oldname, newname in renames.items():
+            rename_branch(newtree, oldname, newname)
+        newtree.Write()
+    finally:
+        outfile.Close()
+        tree.SetBranchStatus('*', 1)
+    return None
+
+def parse_mapping(mapfile):
+    ''' Reads a branch mapping file with one rule per line:
+        old_name  new_name  [jet_indices]  [new_type]
+    new_name '=' copies the branch unchanged. jet_indices is a comma
+    separated list (e.g. 0,1) substituted for {i} in the names, or appended
+    to them if there is no {i}; '-' means no index. Returns the renames
+    (old -> new), the branches kept unchanged and the casts (new -> type). '''
+    renames, keep, casts = dict(), [], dict()
+    with open(mapfile) as f:
+        for line in f:
+            cols = line.split('#')[0].split()
+            if len(cols) == 0:
+                continue
+            if len(cols) < 2:
+                raise ValueError('Bad mapping line: {}'.format(line.strip()))
+            oldname, newname = cols[0], cols[1]
+            indices = [''] if len(cols) < 3 or cols[2] == '-' \
+                else cols[2].split(',')
+            newtype = cols[3] if len(cols) > 3 else None
+            for idx in indices:
+                old = oldname.replace('{i}', idx) if '{i}' in oldname \
+                    else oldname + idx
+                if newname == '=':
+                    keep.append(old)
+                    continue
+                new = newname.replace('{i}', idx) if '{i}' in newname \
+                    else newname + idx
+                renames[old] = new
+                if newtype is not None:
+                    casts[new] = newtype
+    return renames, keep, casts
+
+def renamed_filename(rfilename, savefolder=None, suffix='_NewBranches'):
+    folder = savefolder if savefolder is not None \
+        else os.path.dirname(rfilename)
+    name = os.path.basename(rfilename).replace('.root', '')
+    return os.path.join(folder, name + suffix + '.root')
+
+def open_with_friend(rfilename, friendfilename, treename='tree',
+    alias='renamed'):
+    ''' Opens rfilename with the friend tree written by rename_objects
+    --output-mode friend attached to its tree. The renamed branches read
+    like branches of the tree, or as alias.name where a name exists in
+    both. The file is opened separately from the shared pool, so the
+    friend does not leak to its users. Returns the TFile, which must stay
+    alive while the tree is used, and the tree. '''
+    import ROOT
+    tfile = ROOT.TFile.Open(rfilename)
+    if tfile is None or tfile.IsZombie():
+        raise OSError('Cannot open TFile {}'.format(rfilename))
+    treename = resolve_tree(tfile, treename)
+    tree = tfile.Get(treename)
+    if not tree.AddFriend('{}={}'.format(alias, treename), friendfilename):
+        tfile.Close()
+        raise OSError('Cannot attach {} to {}'.format(friendfilename,
+            rfilename))
+    return tfile, tree
+
+def rename_tree(tree, outfilename, treename, renames, keep=(), casts=None,
+    fast_clone=True, write_options=None, progress=False):
+    ''' Writes the renamed and kept branches of tree to outfilename. Fast
+    cloning is used when possible, RDataFrame otherwise, with progress
+    printed when progress is set. Returns the method used and the reason
+    fast cloning was not possible. '''
+    import ROOT
+    casts = casts or dict()
+    write_options = write_options or dict()
+    reason = None
+    if fast_clone:
+        if casts:
+            reason = 'type changes requested'
+        elif write_options:
+            reason = 'write options requested'
+        else:
+            reason = can_fast_rename(tree, renames, keep)
+        if reason is None:
+            fast_clone_rename(tree, outfilename, treename, renames, keep)
+            return 'fast-clone', None
+
+    df = ROOT.RDataFrame(tree)
+    save_cols = []
+    for oldbranch, newbranch in renames.items():
+        if newbranch in casts:
+            df = df.Define(newbranch, 'static_cast<{}>({})'.format(
+                casts[newbranch], oldbranch))
+        else:
+            df = df.Define(newbranch, oldbranch)
+        save_cols.append(newbranch)
+    save_cols += list(keep)
+    if progress:
+        track_progress(df, tree.GetEntries())
+    df.Snapshot(treename, outfilename, save_cols,
+        snapshot_options(**write_options))
+    if progress:
+        print(file=sys.stderr)
+    return 'rdataframe', reason
+
+def rename_file(rfilename, outfilename, treename, renames, keep=(),
+    casts=None, fast_clone=True, write_options=None, checksum=False,
+    cache_size=None, cache_used_only=False):
+    ''' Worker of the rename_objects batch mode. Branches missing from the
+    file are skipped and reported, errors are returned in the result. The
+    output only appears once complete, with checksum its digest is added to
+    the result. See set_tree_cache for the cache options. '''
+    import ROOT
+    result = dict(file=rfilename, output=outfilename, ok=False)
+    start = time.perf_counter()
+    tfile = None
+    try:
+        tfile = ROOT.TFile.Open(rfilename)
+        if tfile is None or tfile.IsZombie():
+            raise OSError('Cannot open TFile {}'.format(rfilename))
+        treename = resolve_tree(tfile, treename)
+        tree = tfile.Get(treename)
+        result['entries'] = int(tree.GetEntries())
+        names = set(str(b.GetFullName()) for b in tree.GetListOfBranches())
+        present = {old: new for old, new in renames.items() if old in names}
+        result['missing'] = sorted((set(renames) | set(keep)) - names)
+        set_tree_cache(tree, cache_size, sorted((set(renames) | set(keep))
+            & names) if cache_used_only else None)
+        with manifest.atomic_outputs(outfilename) as temps:
+            mode, reason = rename_tree(tree, temps[0], treename, present,
+                [b for b in keep if b in names], casts, fast_clone,
+                write_options)
+        if checksum:
+            result['checksum'] = manifest.file_checksum(outfilename)
+        result.update(bytes_read=int(tfile.GetBytesRead()),
+            read_calls=int(tfile.GetReadCalls()))
+        result.update(renamed=len(present), mode=mode, fallback=reason,
+            ok=True)
+    except Exception as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    finally:
+        if tfile is not None:
+            tfile.Close()
+        result['wall_time'] = time.perf_counter() - start
+    return result
+
+def merge_signature(rfilename, treename='tree'):
+    ''' Entries, size, branches and compression settings of one input of
+    a merge. Trees with equal branches and compression can be merged by
+    copying their compressed baskets. Errors are returned in the result. '''
+    import ROOT
+    result = dict(file=rfilename, tree=treename, ok=False)
+    tfile = None
+    try:
+        tfile = ROOT.TFile.Open(rfilename)
+        if tfile is None or tfile.IsZombie():
+            raise OSError('Cannot open TFile {}'.format(rfilename))
+        result.update(tree_info(get_tree(tfile, treename)),
+            size=int(tfile.GetSize()),
+            compression=int(tfile.GetCompressionSettings()), ok=True)
+    except (OSError, ReferenceError) as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    finally:
+        if tfile is not None:
+            tfile.Close()
+    return result
+
+def merge_groups(signatures, max_bytes=None):
+    ''' Splits the inputs, in order, into groups of at most max_bytes of
+    input each. A file larger than max_bytes gets a group of its own. '''
+    groups = [[]]
+    size = 0
+    for signature in signatures:
+        if max_bytes is not None and groups[-1] and \
+            size + signature['size'] > max_bytes:
+            groups.append([])
+            size = 0
+        groups[-1].append(signature)
+        size += signature['size']
+    return groups if groups[0] else []
+
+def merge_files(rfilenames, outfilename, fast=True, compression=None):
+    ''' Merges every object of rfilenames into outfilename with
+    TFileMerger, trees are concatenated in the given order. fast copies the
+    compressed baskets, otherwise entries are recompressed with compression
+    (100*algorithm+level, default is the one of the first file). '''
+    import ROOT
+    result = dict(output=outfilename, inputs=len(rfilenames), fast=fast,
+        ok=False)
+    try:
+        if compression is None:
+            tfile = ROOT.TFile.Open(rfilenames[0])
+            if tfile is None or tfile.IsZombie():
+                raise OSError('Cannot open TFile {}'.format(rfilenames[0]))
+            compression = int(tfile.GetCompressionSettings())
+            tfile.Close()
+        merger = ROOT.TFileMerger(False, False)
+        merger.SetPrintLevel(0)
+        merger.SetFastMethod(fast)
+        if not merger.OutputFile(outfilename, 'RECREATE', compression):
+            raise OSError('Cannot create {}'.format(outfilename))
+        for rfilename in rfilenames:
+            if not merger.AddFile(rfilename, False):
+                raise OSError('Cannot add {}'.format(rfilename))
+        if not merger.Merge():
+            raise RuntimeError('TFileMerger failed for {}'.format(
+                outfilename))
+        result.update(size=os.path.getsize(outfilename), ok=True)
+    except (OSError, RuntimeError) as err:
+        result['error'] = '{}: {}'.format(type(err).__name__, err)
+    return result
+
+COMPRESSION_ALGORITHMS = {0: 'global', 1: 'zlib', 2: 'lzma', 3: 'old',
+    4: 'lz4', 5: 'zstd'}
+
+def decode_compression(settings):
+    ''' Splits ROOT compression settings (100*algorithm + level). '''
+    settings = int(settings)
+    return dict(settings=settings, level=settings % 100,
+        algorithm=COMPRESSION_ALGORITHMS.get(settings // 100, 'unknown'))
+
+def _basket_count(branch):
+    nbaskets = int(branch.GetWriteBasket())
+    for subbranch in branch.GetListOfBranches():
+        nbaskets += _basket_count(subbranch)
+    return nbaskets
+
+def branch_sizes(tree):
+    ''' Storage report of tree: compressed and uncompressed bytes,
+    compression ratio and basket counts per top level branch (sub-branches
+    included), plus the tree clustering and compression. Only the tree
+    header is used, no baskets are read. '''
+    branches = []
+    for branch in tree.GetListOfBranches():
+        zipbytes = int(branch.GetZipBytes('*'))
+        totbytes = int(branch.GetTotBytes('*'))
+        nbaskets = _basket_count(branch)
+        branches.append(dict(
+            name = str(branch.GetFullName()),
+            compressed = zipbytes,
+            uncompressed = totbytes,
+            ratio = totbytes / zipbytes if zipbytes > 0 else 0.,
+            baskets = nbaskets,
+            avg_basket = zipbytes / nbaskets if nbaskets > 0 else 0.,
+            compression = decode_compression(branch.GetCompressionSettings())))
+
+    entries = int(tree.GetEntries())
+    nclusters = 0
+    it = tree.GetClusterIterator(0)
+    start = it.Next()
+    while start < entries:
+        nclusters += 1
+        start = it.Next()
+    zipbytes = int(tree.GetZipBytes())
+    totbytes = int(tree.GetTotBytes())
+    tfile = tree.GetCurrentFile()
+    return dict(
+        entries = entries,
+        compressed = zipbytes,
+        uncompressed = totbytes,
+        ratio = totbytes / zipbytes if zipbytes > 0 else 0.,
+        autoflush = int(tree.GetAutoFlush()),
+        clusters = nclusters,
+        avg_cluster_entries = entries / nclusters if nclusters > 0 else 0.,
+        compression = decode_compression(tfile.GetCompressionSettings()) \
+            if tfile else None,
+        branches = branches)
+
+_DECLARED = set()
+
+def declare_cpp(name, code):
+    ''' Declares the C++ code defining name to the interpreter once and
+    returns the ROOT binding of name. '''
+    import ROOT
+    if name not in _DECLARED:
+        ROOT.gInterpreter.Declare(code)
+        _DECLARED.add(name)
+    return getattr(ROOT, name)
+
+def read_all_entries(tree):
+    ''' Reads and unpacks every entry of the active branches of tree in a
+    compiled loop, returns the number of uncompressed bytes read. '''
+    read_all = declare_cpp('rh_read_all_entries', """
+    Long64_t rh_read_all_entries(TTree *tree) {
+        Long64_t nbytes = 0;
+        const Long64_t nentries = tree->GetEntries();
+        for (Long64_t i = 0; i < nentries; ++i)
+            nbytes += tree->GetEntry(i);
+        return nbytes;
+    }
+    """)
+    return read_all(tree)
+
+def track_progress(df, total, every=None):
+    ''' Books a Count on df which prints the entries done, events/s and MB/s
+    read to stderr during the event loop, from a compiled callback run every
+    `every` entries of each slot. Returns the count result. '''
+    track = declare_cpp('rh_track_progress', """
+    #include <atomic>
+    #include <chrono>
+    #include <cstdio>
+    #include <memory>
+    #include <mutex>
+    #include "ROOT/RDataFrame.hxx"
+    #include "TFile.h"
+
+    void rh_track_progress(ROOT::RDF::RResultPtr<ULong64_t> &count,
+        ULong64_t every, ULong64_t total)
+    {
+        using clock = std::chrono::steady_clock;
+        const auto start = clock::now();
+        const Long64_t bytes0 = TFile::GetFileBytesRead();
+        auto done = std::make_shared<std::atomic<ULong64_t>>(0);
+        auto print = std::make_shared<std::mutex>();
+        count.OnPartialResultSlot(every, [=](unsigned int, ULong64_t &) {
+            const ULong64_t n = *done += every;
+            std::lock_guard<std::mutex> lock(*print);
+            const double s = std::chrono::duration<double>(
+                clock::now() - start).count();
+            const double mb = (TFile::GetFileBytesRead() - bytes0) / 1e6;
+            std::fprintf(stderr, "\\r    %llu / %llu entries | %.0f ev/s | "
+                "%.1f MB/s   ", n, total, n / s, mb / s);
+            std::fflush(stderr);
+        });
+    }
+    """)
+    count = df.Count()
+    track(count, every or max(1000, int(total) // 200), int(total))
+    return count
+
+SNAPSHOT_ALGORITHMS = ['zlib', 'lzma', 'lz4', 'zstd']
+
+def snapshot_options(algorithm=None, level=None, basket_size=None,
+    autoflush=None, lazy=False):
+    ''' Builds RSnapshotOptions. Raises ValueError if the option is not
+    supported by this ROOT version. '''
+    import ROOT
+    opts = ROOT.RDF.RSnapshotOptions()
+    opts.fLazy = lazy
+    if algorithm is not None:
+        opts.fCompressionAlgorithm = getattr(
+            ROOT.RCompressionSetting.EAlgorithm, 'k'+algorithm.upper())
+    if level is not None:
+        opts.fCompressionLevel = level
+    for name, member, value in [('auto flush', 'fAutoFlush', autoflush),
+        ('basket size', 'fBasketSize', basket_size)]:
+        if value is None:
+            continue
+        if not hasattr(opts, member):
+            raise ValueError('Snapshot {} is not supported by ROOT {}.'\
+                .format(name, ROOT.gROOT.GetVersion()))
+        setattr(opts, member, value)
+    return opts
+
+DICTIONARY_CACHE = os.environ.get('ROOT_HELPERS_DICTS',
+    os.path.join(os.path.expanduser('~'), '.cache', 'root_helpers',
+    'dictionaries'))
+
+def load_dictionary(classname, headers, cache_dir=None):
+    ''' Loads the dictionary library of classname, generating it with ACLiC
+    into the cache folder the first time (per ROOT version), so later runs
+    only pay for loading the library. '''
+    import ROOT
+    cache_dir = cache_dir or DICTIONARY_CACHE
+    tag = hashlib.sha1('{} {} {}'.format(classname, headers,
+        ROOT.gROOT.GetVersion()).encode()).hexdigest()[:16]
+    folder = os.path.join(cache_dir, tag)
+    libs = glob.glob(os.path.join(folder, '*.so'))
+    if len(libs) == 0:
+        # build in a private folder, several jobs may race for the cache
+        tmpfolder = '{}.tmp{}'.format(folder, os.getpid())
+        os.makedirs(tmpfolder, exist_ok=True)
+        cwd = os.getcwd()
+        os.chdir(tmpfolder)
+        try:
+            ROOT.gInterpreter.GenerateDictionary(classname, headers)
+        finally:
+            os.chdir(cwd)
+        try:
+            os.rename(tmpfolder, folder)
+        except OSError:
+            shutil.rmtree(tmpfolder, ignore_errors=True)
+        libs = glob.glob(os.path.join(folder, '*.so'))
+    for lib in libs:
+        if ROOT.gSystem.Load(lib) < 0:
+            raise OSError('Cannot load dictionary {}'.format(lib))
+    return libs
+
+# numeric leaf type -> (C++ type read by TTreeReaderValue, numpy dtype)
+LEAF_TYPES = {
+    'Float_t': ('float', '<f4'), 'float': ('float', '<f4'),
+    'Double_t': ('double', '<f8'), 'double': ('double', '<f8'),
+    'Int_t': ('int', '<i4'), 'int': ('int', '<i4'),
+    'UInt_t': ('unsigned int', '<u4'),
+    'unsigned int': ('unsigned int', '<u4'),
+    'Long64_t': ('Long64_t', '<i8'), 'ULong64_t': ('ULong64_t', '<u8'),
+    # TTreeReaderValue checks the exact type, Long_t is not Long64_t
+    'Long_t': ('long', '<i8'), 'long': ('long', '<i8'),
+    'ULong_t': ('unsigned long', '<u8'),
+    'unsigned long': ('unsigned long', '<u8'),
+    'Short_t': ('short', '<i2'), 'short': ('short', '<i2'),
+    'UShort_t': ('unsigned short', '<u2'),
+    'unsigned short': ('unsigned short', '<u2'),
+    'Char_t': ('char', 'i1'), 'UChar_t': ('unsigned char', 'u1'),
+    'Bool_t': ('bool', '?'), 'bool': ('bool', '?'),
+}
+NUMERIC_TYPES = frozenset(LEAF_TYPES)
+
+def is_histogrammable(typename):
+    ''' Numeric scalars and vectors of numbers can be filled by Histo1D. '''
+    typename = typename.replace(' ', '')
+    if typename.startswith('vector<') and typename.endswith('>'):
+        typename = typename[len('vector<'):-1]
+    return typename.replace('unsigned', 'unsigned ') in NUMERIC_TYPES \
+        or typename in NUMERIC_TYPES
+
+def sampled_ranges(tree, columns, sample_entries=10000):
+    ''' (min, max) of each column over the first sample_entries entries,
+    computed in one single-threaded pass. Must run before multithreading
+    is enabled, Range is not allowed with it. '''
+    import ROOT
+    df = ROOT.RDataFrame(tree).Range(sample_entries)
+    mins = {col: df.Min(col) for col in columns}
+    maxs = {col: df.Max(col) for col in columns}
+    return {col: (float(mins[col].GetValue()), float(maxs[col].GetValue()))
+        for col in columns}
+
+def histogram_range(lo, hi):
+    ''' Axis limits for the sampled (min, max) of a column, padded so the
+    extremes are not at the bin edges. None if nothing was sampled, e.g. a
+    vector branch empty in every sampled entry, for which RDataFrame gives
+    (DBL_MAX, -DBL_MAX). '''
+    if not (math.isfinite(lo) and math.isfinite(hi)) or hi < lo or \
+        not math.isfinite(hi - lo):
+        return None
+    if hi == lo:
+        lo, hi = lo - 0.5, hi + 0.5
+    margin = 0.01 * (hi - lo)
+    return lo - margin, hi + margin
+
+def branch_histograms(treename, rfilename, ranges, bins=50):
+    ''' Books one TH1D per column of ranges on a single RDataFrame and fills
+    them all in one (multithreaded if enabled) event loop. Returns the
+    histograms by column, columns without a usable sampled range are
+    skipped. '''
+    import ROOT
+    df = ROOT.RDataFrame(treename, rfilename)
+    results = dict()
+    for col, (lo, hi) in ranges.items():
+        limits = histogram_range(lo, hi)
+        if limits is None:
+            print('Skipping {}, no values in the sampled entries.'.format(col))
+            continue
+        model = ROOT.RDF.TH1DModel('h_'+col.replace('.', '_'), col, bins,
+            *limits)
+        results[col] = df.Histo1D(model, col)
+    # the first GetValue runs the event loop for every histogram
+    return {col: result.GetValue() for col, result in results.items()}
+
+def flatten_nested(df, column):
+    ''' Defines column_n, column_offsets and column_values from the
+    vector<vector<T>> column: the number of inner vectors, their n+1 start
+    positions in column_values, and every inner value in one flat vector.
+    Writing these needs no dictionary. Returns df and the new columns. '''
+    declare_cpp('rh_flatten_nested', """
+    #include <vector>
+    #include "ROOT/RVec.hxx"
+
+    template <typename T>
+    ROOT::RVec<T> rh_flatten_values(const ROOT::RVec<std::vector<T>> &nested)
+    {
+        std::size_t n = 0;
+        for (const auto &inner : nested)
+            n += inner.size();
+        ROOT::RVec<T> values;
+        values.reserve(n);
+        for (const auto &inner : nested)
+            values.insert(values.end(), inner.begin(), inner.end());
+        return values;
+    }
+
+    template <typename T>
+    ROOT::RVec<int> rh_flatten_offsets(
+        const ROOT::RVec<std::vector<T>> &nested)
+    {
+        ROOT::RVec<int> offsets(nested.size() + 1);
+        offsets[0] = 0;
+        for (std::size_t i = 0; i < nested.size(); ++i)
+            offsets[i+1] = offsets[i] + nested[i].size();
+        return offsets;
+    }
+    """)
+    df = df.Define(column + '_n', 'int({}.size())'.format(column)) \
+        .Define(column + '_offsets', 'rh_flatten_offsets({})'.format(column)) \
+        .Define(column + '_values', 'rh_flatten_values({})'.format(column))
+    return df, [column + suffix for suffix in ('_n', '_offsets', '_values')]
+
+def nested_at(column, index):
+    ''' Expression of the index-th inner vector of a column written by
+    flatten_nested, an RVec viewing column_values without copying (empty
+    if the entry has fewer inner vectors). For use in Define and Filter. '''
+    declare_cpp('rh_nested_at', """
+    #include "ROOT/RVec.hxx"
+
+    template <typename T>
+    ROOT::RVec<T> rh_nested_at(const ROOT::RVec<T> &values,
+        const ROOT::RVec<int> &offsets, std::size_t i)
+    {
+        if (i + 1 >= offsets.size())
+            return ROOT::RVec<T>();
+        // non-owning view, no allocation
+        return ROOT::RVec<T>(const_cast<T *>(values.data()) + offsets[i],
+            offsets[i+1] - offsets[i]);
+    }
+    """)
+    return 'rh_nested_at({0}_values, {0}_offsets, {1})'.format(column, index)
+
+def set_tree_cache(tree, size_mb=None, branches=None):
+    ''' Sets the cache size of tree and, if branches are given, registers
+    them so no learning phase is needed. Only loops reading tree itself
+    (single threaded) use these. '''
+    if size_mb is not None:
+        tree.SetCacheSize(int(size_mb * 1024 * 1024))
+    if branches is not None:
+        for name in branches:
+            tree.AddBranchToCache(name, True)
+        tree.StopCacheLearningPhase()
+
+def used_branches(columns, expressions):
+    ''' The columns that appear in any of the expressions. '''
+    return [col for col in columns if any(re.search(r'\b{}\b'.format(
+        re.escape(col)), expr) for expr in expressions)]
+
+def read_stats():
+    ''' Bytes read and read calls of every TFile of this process. '''
+    import ROOT
+    return dict(bytes_read=int(ROOT.TFile.GetFileBytesRead()),
+        read_calls=int(ROOT.TFile.GetFileReadCalls()))
+
+def print_read_stats():
+    stats = read_stats()
+    print('Read {:.1f} MB in {} calls ({:.1f} kB per call)'.format(
+        stats['bytes_read'] / 1e6, stats['read_calls'],
+        stats['bytes_read'] / 1e3 / max(1, stats['read_calls'])))
 
+def select_columns(columns, include=None, exclude=None, include_regex=None,
+    exclude_regex=None):
+    ''' Columns kept by the include/exclude names and regexes, in their
+    original order. With no include option every column is included, the
+    exclude options are applied afterwards. '''
+    columns = [str(col) for col in columns]
+    if include is not None or include_regex is not None:
+        names = set(include or [])
+        missing = names - set(columns)
+        if missing:
+            print('Branches not in tree: {}'.format(sorted(missing)))
+        patterns = [re.compile(p) for p in include_regex or []]
+        columns = [col for col in columns if col in names
+            or any(p.fullmatch(col) for p in patterns)]
+    names = set(exclude or [])
+    patterns = [re.compile(p) for p in exclude_regex or []]
+    return [col for col in columns if col not in names
+        and not any(p.fullmatch(col) for p in patterns)]